@@ -46,7 +46,7 @@ async def connect_url(update: Update, context):
     subscription = Subscription.model_validate(subscription_data)
 
     # Prepare the response message with the subscriptions links
-    text = f'🔗 لینک های *اتصال*: \n\n{subscription.get_links_message()}'
+    text = f'🔗 لینک های *اتصال*: \n\n{await subscription.get_links_message_async()}'
 
     # Set up inline keyboard buttons for the user response
     keyboard = [[InlineKeyboardButton("🖥️ بازگشت به پنل", callback_data="menu")]]
@@ -51,7 +51,7 @@ async def get_test(update: Update, context):
     remaining_seconds = (subscription.expiry_time - datetime.datetime.now()).total_seconds()
 
     # Compose the message
-    text = f'🔗 لینک های *اتصال*: \n\n{subscription.get_links_message()}'
+    text = f'🔗 لینک های *اتصال*: \n\n{await subscription.get_links_message_async()}'
 
     reply_markup = InlineKeyboardMarkup(create_keyboard(remaining_traffic, remaining_seconds, subscription))
 
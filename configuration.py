@@ -1,13 +1,136 @@
+import logging
+import os
+import threading
+
 import pymongo as pymongo
 import yaml
+from pymongo import monitoring
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Connection pool events of the shared MongoDB clients.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checkout_failures = 0
+        self.in_use = 0
+        self.max_in_use = 0
+
+    def _count(self, field: str, in_use: int = 0):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + 1)
+            self.in_use += in_use
+            self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def connection_created(self, event):
+        self._count('created')
+
+    def connection_closed(self, event):
+        self._count('closed')
+
+    def connection_check_out_failed(self, event):
+        self._count('checkout_failures')
+
+    def connection_checked_out(self, event):
+        self._count('checked_out', 1)
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.in_use -= 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def __str__(self):
+        with self.lock:
+            return (f'open={self.created - self.closed} created={self.created} closed={self.closed} '
+                    f'in_use={self.in_use} max_in_use={self.max_in_use} checkouts={self.checked_out} '
+                    f'checkout_failures={self.checkout_failures}')
+
+
+pool_metrics = PoolMetrics()
+
+# Parsed configuration files and MongoDB clients shared by every Config of the process. They are
+# rebuilt after a fork, since a MongoClient must not be used across fork().
+_registry_lock = threading.Lock()
+_registry_pid = None
+_files = {}
+_clients = {}
+
+
+def _check_pid():
+    global _registry_pid
+    if _registry_pid != os.getpid():
+        _files.clear()
+        _clients.clear()
+        _registry_pid = os.getpid()
+
+
+def load_file(path: str) -> dict:
+    """
+    Parse a configuration file once per process.
+    """
+    with _registry_lock:
+        _check_pid()
+        key = os.path.abspath(path)
+        if key not in _files:
+            with open(path, 'r', encoding='utf-8') as stream:  # added encoding='utf-8'
+                _files[key] = yaml.safe_load(stream)
+        return _files[key]
+
+
+def get_client(uri: str, asynchronous: bool = False, **options):
+    """
+    Get the process-wide MongoDB client for a URI and options, creating it on first use.
+
+    Args:
+        uri (str): MongoDB connection string.
+        asynchronous (bool): Whether to get a motor client instead of a pymongo one.
+        **options: Client options, e.g. maxPoolSize.
+
+    Returns:
+        pymongo.MongoClient or motor.motor_asyncio.AsyncIOMotorClient: The shared client.
+    """
+    with _registry_lock:
+        _check_pid()
+        key = (uri, asynchronous, tuple(sorted(options.items())))
+        if key not in _clients:
+            if asynchronous:
+                from motor.motor_asyncio import AsyncIOMotorClient
+                _clients[key] = AsyncIOMotorClient(uri, event_listeners=[pool_metrics], **options)
+            else:
+                _clients[key] = pymongo.MongoClient(uri, event_listeners=[pool_metrics], **options)
+        return _clients[key]
+
+
+def log_pool_metrics():
+    logging.info(f"MongoDB connections: {pool_metrics}")
 
 
 class Config:
 
     def __init__(self, path='configuration.yaml'):
-        with open(path, 'r', encoding='utf-8') as stream:  # added encoding='utf-8'
-            self.config = yaml.safe_load(stream)
-        stream.close()
+        self.config = load_file(path)
         self.mode = self.config['mode']
         self.token = self.config[self.mode][0]['token']
         self.botname = self.config[self.mode][0]['botname']
@@ -25,9 +148,52 @@ class Config:
         self.traffic_plans = self.config[self.mode][0]['traffic-plans']
         self.enforced_channels = self.config[self.mode][0]['force-channels']
         self.mongo_uri = self.config[self.mode][0]['database']
-        client = pymongo.MongoClient(self.mongo_uri, uuidRepresentation="standard")
-        self.db = client.xui
+        socket_timeout_ms = int(self.config[self.mode][0].get('mongo-socket-timeout-ms', 0))
+        self.mongo_options = {
+            'uuidRepresentation': 'standard',
+            'maxPoolSize': int(self.config[self.mode][0].get('mongo-max-pool-size', 50)),
+            'minPoolSize': int(self.config[self.mode][0].get('mongo-min-pool-size', 0)),
+            'connectTimeoutMS': int(self.config[self.mode][0].get('mongo-connect-timeout-ms', 5000)),
+            'serverSelectionTimeoutMS': int(self.config[self.mode][0].get('mongo-server-selection-timeout-ms', 10000)),
+            'socketTimeoutMS': socket_timeout_ms or None,
+        }
+        self.db = get_client(self.mongo_uri, **self.mongo_options).xui
         self.admin = self.config[self.mode][0]['admin']
+        self.usage_updater_workers = int(self.config[self.mode][0].get('usage-updater-workers', 8))
+        self.usage_updater_deadline = float(self.config[self.mode][0].get('usage-updater-deadline', 12))
+        self.usage_accounting = self.config[self.mode][0].get('usage-accounting', 'reset')
+        self.subscription_servers_layout = self.config[self.mode][0].get('subscription-servers-layout', 'dict')
+        self.usage_updater_mode = self.config[self.mode][0].get('usage-updater-mode', 'bot')
+        self.usage_worker_vnodes = int(self.config[self.mode][0].get('usage-worker-vnodes', 64))
+        self.usage_server_lease_seconds = float(self.config[self.mode][0].get('usage-server-lease-seconds', 60))
+        self.usage_poll_min_interval = float(self.config[self.mode][0].get('usage-poll-min-interval', 5))
+        self.usage_poll_base_interval = float(self.config[self.mode][0].get('usage-poll-base-interval', 15))
+        self.usage_poll_max_interval = float(self.config[self.mode][0].get('usage-poll-max-interval', 120))
+        self.usage_poll_near_limit = float(self.config[self.mode][0].get('usage-poll-near-limit', 0.1))
+        self.usage_poll_fast_rate = float(self.config[self.mode][0].get('usage-poll-fast-rate', 1))
+        self.inbound_cache_ttl = float(self.config[self.mode][0].get('inbound-cache-ttl', 300))
+        self.panel_health_window = int(self.config[self.mode][0].get('panel-health-window', 20))
+        self.panel_failure_threshold = int(self.config[self.mode][0].get('panel-failure-threshold', 5))
+        self.panel_error_rate = float(self.config[self.mode][0].get('panel-error-rate', 0.5))
+        self.panel_cooldown = float(self.config[self.mode][0].get('panel-cooldown', 30))
+        self.panel_retry_attempts = int(self.config[self.mode][0].get('panel-retry-attempts', 3))
+        self.panel_retry_base_delay = float(self.config[self.mode][0].get('panel-retry-base-delay', 0.5))
+        self.panel_retry_max_delay = float(self.config[self.mode][0].get('panel-retry-max-delay', 30))
+        self.panel_retry_budget = int(self.config[self.mode][0].get('panel-retry-budget', 30))
+        self.add_queue_poll_interval = float(self.config[self.mode][0].get('add-queue-poll-interval', 10))
+        self.add_batch_size = int(self.config[self.mode][0].get('add-batch-size', 100))
+        self.add_batch_window_ms = float(self.config[self.mode][0].get('add-batch-window-ms', 1000))
+        self.add_batch_max = int(self.config[self.mode][0].get('add-batch-max', 200))
+        self.delete_workers = int(self.config[self.mode][0].get('delete-workers', 4))
+        self.delete_bulk_threshold = int(self.config[self.mode][0].get('delete-bulk-threshold', 0))
+        self.inbound_lease_seconds = float(self.config[self.mode][0].get('inbound-lease-seconds', 60))
+        self.queue_lease_seconds = float(self.config[self.mode][0].get('queue-lease-seconds', 120))
+        self.queue_max_attempts = int(self.config[self.mode][0].get('queue-max-attempts', 10))
+        self.queue_retry_base_delay = float(self.config[self.mode][0].get('queue-retry-base-delay', 5))
+        self.queue_retry_max_delay = float(self.config[self.mode][0].get('queue-retry-max-delay', 600))
+        self.queue_claim_limit = int(self.config[self.mode][0].get('queue-claim-limit', 500))
+        self.scheduler_workers = int(self.config[self.mode][0].get('scheduler-workers', 4))
+        self.leader_lease_seconds = float(self.config[self.mode][0].get('leader-lease-seconds', 15))
 
     def get_mode(self):
         return self.mode
@@ -55,6 +221,12 @@ class Config:
 
         return self.db
 
+    def get_async_db(self):
+        """
+        The database on the process-wide motor client, for asyncio code.
+        """
+        return get_client(self.mongo_uri, asynchronous=True, **self.mongo_options).xui
+
     def show_label(self):
         from ansimarkup import ansiprint as print
         from pyfiglet import figlet_format
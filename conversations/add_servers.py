@@ -10,7 +10,7 @@ from telegram.ext import (
 from callback.menu import menu
 from configuration import Config
 from models.server import Server
-from utilities import api_call
+from utilities import async_api_call
 
 config = Config('configuration.yaml')
 servers_db = config.get_db().servers
@@ -59,7 +59,7 @@ async def inbound_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             {'ip_address': context.user_data['server']['ip_address'], 'inbound_id': int(update.message.text)}):
         return await _send_message(update, '❌ لطفا *اینباند دیگری* را ارائه دهید. _(در سرور ها وجود دارد)_', INBOUND_ID)
 
-    r = api_call.get_inbound(
+    r = await async_api_call.get_inbound(
         f"http://{context.user_data['server']['ip_address']}:{context.user_data['server']['panel_port']}",
         context.user_data['server']['panel_username'], context.user_data['server']['panel_password'],
         int(update.message.text))
@@ -1,18 +1,18 @@
-import asyncio
-import threading
-import time
-
 from telegram.ext import Application, CallbackQueryHandler
 from handlers.index import index
 from conversations.index import conversations
 from callback.index import handlers
 from telegram.ext import CommandHandler
-from configuration import Config
+from configuration import Config, log_pool_metrics
 from minute_tasks import add_client, delete_client, usage_updater, usage_expiry_scanner, currency_scanner, invoice_check, send_notification
 
 import logging
 
 from models.prices import Prices
+from utilities.indexes import ensure_indexes, log_index_report
+from utilities.leader import LeaderLease
+from utilities.scheduler import Scheduler
+from utilities.subscription_layout import migrate_cron
 
 import sys
 
@@ -65,22 +65,37 @@ config = Config('configuration.yaml')
 config.show_label()
 subscriptions = config.get_db().subscriptions
 
-def run_periodically(function, interval, *args):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+scheduler = Scheduler(config.scheduler_workers, lease_factory=LeaderLease)
+
+
+async def start_scheduler(application: Application):
+    scheduler.add_service('add-client-worker', add_client.worker)
+    scheduler.add_job('delete-client', delete_client.cron, 1, leader=True)
+    if config.usage_updater_mode == 'bot':
+        scheduler.add_job('usage-updater', usage_updater.cron, config.usage_poll_min_interval, leader=True)
+    scheduler.add_job('usage-expiry-scanner', usage_expiry_scanner.cron, 60, leader=True)
+    scheduler.add_job('usd-currency-scanner', currency_scanner.usd_cron, 3600, leader=True)
+    scheduler.add_job('crypto-currency-scanner', currency_scanner.crypto_cron, 60, leader=True)
+    scheduler.add_job('invoice-check', invoice_check.cron_job, 30, application, leader=True)
+    scheduler.add_job('send-notification', send_notification.cron, 30, application, leader=True)
+    scheduler.add_job('scheduler-stats', scheduler.log_stats, 600)
+    scheduler.add_job('add-client-stats', add_client.log_metrics, 600)
+    scheduler.add_job('mongo-pool-stats', log_pool_metrics, 600)
+    scheduler.add_job('index-report', log_index_report, 86400, leader=True)
+    scheduler.add_job('subscription-layout-migration', migrate_cron, 60, leader=True)
+    scheduler.start()
+
 
-    while True:
-        if asyncio.iscoroutinefunction(function):
-            loop.run_until_complete(function(*args))
-        else:
-            function(*args)
-        time.sleep(interval)
+async def stop_scheduler(application: Application):
+    await scheduler.stop()
 
 
 def main():
+    ensure_indexes()
+    usage_expiry_scanner.backfill_remaining()
     Prices(name="Default", plans=config.traffic_plans).commit_changes()
-    application = Application.builder().token(config.token).build()
-    job_queue = application.job_queue
+    application = (Application.builder().token(config.token)
+                   .post_init(start_scheduler).post_shutdown(stop_scheduler).build())
 
     for k, v in index().items():
         application.add_handler(CommandHandler(k, v))
@@ -89,21 +104,6 @@ def main():
     for convo in conversations():
         application.add_handler(convo)
 
-    add_user_cron = threading.Thread(target=run_periodically, args=(add_client.cron, 1))
-    remove_user_cron = threading.Thread(target=run_periodically, args=(delete_client.cron, 1))
-    usage_updater_cron = threading.Thread(target=run_periodically, args=(usage_updater.cron, 15))
-    usage_expiry_scanner_cron = threading.Thread(target=run_periodically, args=(usage_expiry_scanner.cron, 60))
-    usd_currency_scanner_cron = threading.Thread(target=run_periodically, args=(currency_scanner.usd_cron, 3600))
-    crypto_currency_scanner_cron = threading.Thread(target=run_periodically, args=(currency_scanner.crypto_cron, 60))
-
-    add_user_cron.start()
-    remove_user_cron.start()
-    usage_updater_cron.start()
-    usage_expiry_scanner_cron.start()
-    usd_currency_scanner_cron.start()
-    crypto_currency_scanner_cron.start()
-    job_queue.run_repeating(invoice_check.cron_job, interval=30)
-    job_queue.run_repeating(send_notification.cron, interval=30)
     application.run_polling()
 
 main()
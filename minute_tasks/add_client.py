@@ -1,49 +1,359 @@
+import datetime
+import json
 import logging
+import threading
+import time
+from typing import Optional, Tuple
+
+from pymongo.errors import OperationFailure, PyMongoError
+
 from configuration import Config
 from models.server import Server
+from utilities.api_call import PanelError
+from utilities.job_queue import JobQueue
+from utilities.leader import LeaderLease
 
 config = Config()
 servers_db = config.get_db().servers
 add_queue_db = config.get_db().add_queue  # MongoDB collection for adding clients queue
+add_queue = JobQueue(add_queue_db)
+delete_queue_db = config.get_db().delete_queue
+usage_counters_db = config.get_db().usage_counters
+
+
+class ProvisionMetrics:
+    """
+    Sizes of the addClient batches sent to panels and the time from enqueueing a client to it
+    being added.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.clients = 0
+        self.max_batch = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, jobs: list):
+        now = add_queue.now()
+        latencies = [(now - job['created_at']).total_seconds() for job in jobs if job.get('created_at')]
+        with self.lock:
+            self.batches += 1
+            self.clients += len(jobs)
+            self.max_batch = max(self.max_batch, len(jobs))
+            self.total_latency += sum(latencies)
+            self.max_latency = max([self.max_latency, *latencies])
+
+    def __str__(self):
+        with self.lock:
+            average_batch = self.clients / self.batches if self.batches else 0.0
+            average_latency = self.total_latency / self.clients if self.clients else 0.0
+            return (f'batches={self.batches} clients={self.clients} avg_batch={average_batch:.1f} '
+                    f'max_batch={self.max_batch} avg_time_to_provision={average_latency:.2f}s '
+                    f'max_time_to_provision={self.max_latency:.2f}s')
+
+
+metrics = ProvisionMetrics()
+
+
+def log_metrics():
+    logging.info(f"Add client batches: {metrics}")
 
 
 def add_job(account, server: Server) -> bool:
+    """
+    Enqueue adding a client to a server, coalesced with the jobs still waiting for the same client:
+    a waiting add gets the new settings instead of a second add, and a waiting delete is turned
+    into an edit of the client, which still exists on the panel.
+
+    Only unclaimed jobs (no owner) are coalesced, so a job a worker is running is never changed.
+    """
+    key = {'server': server.mongo_id, 'uuid': account['id'], 'owner': None}
     try:
-        add_queue_db.insert_one({'account': account, 'server': server.mongo_id})
-        logging.info(f"Enqueued job for account: {account} on server: {server.mongo_id}")
+        if add_queue_db.find_one_and_update(key, {'$set': {'account': account}}):
+            logging.info(f"Merged job for account: {account} into a pending job on server: {server.mongo_id}")
+            return True
+
+        op = 'edit' if delete_queue_db.find_one_and_delete(key) else 'add'
+        add_queue.put({'account': account, 'server': server.mongo_id, 'uuid': account['id'], 'op': op})
+        logging.info(f"Enqueued {op} job for account: {account} on server: {server.mongo_id}")
         return True
     except Exception as e:
         logging.error(f"Failed to enqueue job for account: {account} on server: {server.mongo_id}. Error: {e}")
         return False
 
 
-def cron():
+def inbound_lease(server_id) -> LeaderLease:
+    """
+    Lease serializing the add worker with bulk deletes (see delete_client.delete_clients) on a
+    server: a bulk delete rewrites the inbound's whole client list, which would drop a client
+    added meanwhile.
+    """
+    return LeaderLease(f'inbound:{server_id}', config.inbound_lease_seconds)
+
+
+def release_jobs(jobs: list, error: str):
+    for job in jobs:
+        add_queue.release(job, error)
+
+
+def is_poison(error: Exception) -> bool:
+    """
+    Whether the panel rejected the request because of its content rather than being unavailable.
+    """
+    return isinstance(error, PanelError) and not error.transient
+
+
+def restart_counters(server: Server, jobs: list):
+    """
+    Zero the panel counters of the clients about to be edited in place, and the stored counters
+    of their new emails (see usage_updater.counter_deltas).
+
+    The client of an edit job belonged to a subscription that was just expired; without this its
+    cumulative up and down would be billed again to the renewed subscription and could already
+    exceed the new totalGB, making the panel disable the client right away.
+    """
+    by_id = {client['id']: client['email'] for client in json.loads(server.get_inbound()['settings'])['clients']}
+    for job in jobs:
+        if job['uuid'] in by_id:
+            server.reset_client_traffic(by_id[job['uuid']])
+        usage_counters_db.update_one({'server': server.mongo_id, 'email': job['account']['email']},
+                                     {'$set': {'up': 0, 'down': 0}}, upsert=True)
+
+
+def edit_clients(server: Server, jobs: list, done: list) -> list:
+    """
+    Edit the clients of a server's edit jobs in place and return the jobs whose client turned out
+    to be gone, which have to be added instead. Jobs the panel rejects are dead-lettered.
+
+    Args:
+        server (Server): The server.
+        jobs (list): The server's edit jobs.
+        done (list): Collects the IDs of the jobs that were edited or dead-lettered.
+    """
+    if jobs:
+        restart_counters(server, jobs)
+
+    missing = []
+    for job in jobs:
+        try:
+            server.edit_client(job['uuid'], job['account'])
+            done.append(job['_id'])
+        except PanelError as e:
+            if 'not found' in str(e).lower():
+                missing.append(job)
+            elif is_poison(e):
+                logging.error(f"Dead-lettering edit job {job['_id']} for server: {server.mongo_id}. Error: {e}")
+                add_queue.dead_letter(job, str(e))
+                done.append(job['_id'])
+            else:
+                raise
+    return missing
+
+
+def add_batch(server: Server, jobs: list, done: list):
+    """
+    Add the clients of a batch of jobs to a server. When the panel rejects the batch, it is split
+    in halves that are tried on their own, down to the single jobs the panel rejects, which are
+    dead-lettered with the panel's error so the rest of the batch goes through.
+
+    Args:
+        server (Server): The server.
+        jobs (list): The server's add jobs.
+        done (list): Collects the IDs of the jobs whose clients were added or that were dead-lettered.
+
+    Raises:
+        Exception: If the panel is unavailable; the jobs not in `done` are still pending.
+    """
     try:
-        current_queue = list(add_queue_db.find({}))
+        server.add_client([job['account'] for job in jobs])
     except Exception as e:
-        logging.error(f"Failed to fetch jobs from the queue. Error: {e}")
+        if not is_poison(e):
+            raise
+        if len(jobs) == 1:
+            logging.error(f"Dead-lettering add job {jobs[0]['_id']} for server: {server.mongo_id}. Error: {e}")
+            add_queue.dead_letter(jobs[0], str(e))
+            done.append(jobs[0]['_id'])
+            return
+        middle = len(jobs) // 2
+        add_batch(server, jobs[:middle], done)
+        add_batch(server, jobs[middle:], done)
         return
+    metrics.record(jobs)
+    done.extend(job['_id'] for job in jobs)
+
+
+def ready_servers() -> Tuple[list, Optional[datetime.datetime]]:
+    """
+    Servers whose pending jobs should be flushed now: at least `add-batch-size` are waiting, or the
+    oldest has waited `add-batch-window-ms`.
 
+    Returns:
+        Tuple[list, Optional[datetime.datetime]]: IDs of the ready servers, and when the next of
+            the other servers becomes ready, None if no other server has pending jobs.
+    """
+    window = datetime.timedelta(milliseconds=config.add_batch_window_ms)
+    now = add_queue.now()
+    ready, next_flush = [], None
+    for pending in add_queue_db.aggregate([
+        {'$match': add_queue.claim_query(None)},
+        {'$group': {'_id': '$server', 'count': {'$sum': 1}, 'oldest': {'$min': '$available_at'}}}
+    ]):
+        due = (pending['oldest'] or datetime.datetime.min) + window
+        if pending['count'] >= config.add_batch_size or due <= now:
+            ready.append(pending['_id'])
+        elif next_flush is None or due < next_flush:
+            next_flush = due
+    return ready, next_flush
+
+
+def release_leases(leases: dict):
+    for lease in leases.values():
+        try:
+            if lease.is_leader:
+                lease.release()
+        except Exception as e:
+            logging.error(f"Failed to release lease {lease.name}. Error: {e}")
+
+
+def renew(lease: LeaderLease):
+    if not lease.acquire():
+        raise RuntimeError(f'Lease {lease.name} was taken over')
+
+
+def cron() -> Optional[datetime.datetime]:
+    """
+    Provision the pending clients of the servers that are ready (see ready_servers), in addClient
+    calls of at most `add-batch-max` clients. A server whose inbound lease is held by a bulk
+    delete is skipped, and its jobs stay unclaimed until a later run.
+
+    Returns:
+        Optional[datetime.datetime]: When the next server becomes ready, None if none is waiting.
+    """
+    leases = {}
+    try:
+        ready, next_flush = ready_servers()
+        # Servers a bulk delete is rewriting are left for a later run, before their jobs are claimed
+        for server_id in ready:
+            lease = inbound_lease(server_id)
+            if lease.acquire():
+                leases[server_id] = lease
+        current_queue = add_queue.claim_many(config.queue_claim_limit, {'server': {'$in': list(leases)}}) \
+            if leases else []
+    except Exception as e:
+        logging.error(f"Failed to claim jobs from the queue. Error: {e}")
+        release_leases(leases)
+        return None
+
+    try:
+        provision(current_queue, leases)
+    finally:
+        release_leases(leases)
+    return next_flush
+
+
+def provision(current_queue: list, leases: dict):
+    """
+    Add and edit the clients of claimed jobs, server by server, renewing each server's inbound
+    lease (see inbound_lease) before every step that changes its clients.
+    """
     if not current_queue:
-        logging.info("The add queue is empty.")
         return
 
-    grouped_accounts = {}
+    grouped_jobs = {}
     for job in current_queue:
-        grouped_accounts.setdefault(job['server'], []).append(job['account'])
+        grouped_jobs.setdefault(job['server'], []).append(job)
 
-    server_ids = list(grouped_accounts.keys())
+    server_ids = list(grouped_jobs.keys())
     try:
         servers = [Server.model_validate(data) for data in servers_db.find({'_id': {'$in': server_ids}})]
     except Exception as e:
         logging.error(f"Error validating servers. Error: {e}")
+        release_jobs(current_queue, str(e))
         return
 
+    for server_id in set(server_ids) - {server.mongo_id for server in servers}:
+        # Retrying can't help once the server is gone
+        logging.error(f"Dead-lettering {len(grouped_jobs[server_id])} jobs of missing server: {server_id}")
+        for job in grouped_jobs[server_id]:
+            add_queue.dead_letter(job, f'Server {server_id} not found')
+
     for server in servers:
-        accounts_to_add = grouped_accounts[server.mongo_id]
+        jobs = grouped_jobs[server.mongo_id]
+        done = []
         try:
-            server.add_client(accounts_to_add)
-            add_queue_db.delete_many({'server': server.mongo_id, 'account': {'$in': accounts_to_add}})
+            adds = [job for job in jobs if job.get('op') != 'edit']
+            renew(leases[server.mongo_id])
+            adds += edit_clients(server, [job for job in jobs if job.get('op') == 'edit'], done)
+            for index in range(0, len(adds), config.add_batch_max):
+                renew(leases[server.mongo_id])
+                add_batch(server, adds[index:index + config.add_batch_max], done)
             logging.info(f"Successfully added clients for server: {server.mongo_id}")
         except Exception as e:
+            finished = set(done)
+            release_jobs([job for job in jobs if job['_id'] not in finished], str(e))
             logging.error(f"Failed to add clients for server: {server.mongo_id}. Error: {e}")
+        add_queue.ack(done)
+
+
+def due(next_flush: Optional[datetime.datetime]) -> bool:
+    return next_flush is not None and next_flush <= add_queue.now()
+
+
+def run_cron() -> Optional[datetime.datetime]:
+    """
+    Run the cron, logging and backing off on any error instead of letting it end the worker
+    thread, which nothing would restart.
+    """
+    try:
+        return cron()
+    except Exception as e:
+        logging.exception(f"Add client cron failed. Error: {e}")
+        time.sleep(config.add_queue_poll_interval)
+        return None
+
+
+def watch():
+    """
+    Run the cron whenever a job is inserted into the add queue, and at least every
+    `add-queue-poll-interval` seconds so failed jobs are retried once their backoff ends.
+
+    Raises:
+        PyMongoError: If the change stream can't be opened or breaks.
+    """
+    max_await_time_ms = max(1, min(1000, int(config.add_batch_window_ms)))
+    with add_queue_db.watch([{'$match': {'operationType': 'insert'}}], max_await_time_ms=max_await_time_ms) as stream:
+        next_flush = run_cron()  # Catch up on jobs enqueued before the stream was opened
+        last_run = time.monotonic()
+        while stream.alive:
+            change = stream.try_next()
+            if change is not None or due(next_flush) or \
+                    time.monotonic() - last_run >= config.add_queue_poll_interval:
+                next_flush = run_cron()
+                last_run = time.monotonic()
+
+
+def worker():
+    """
+    Provision clients as soon as they are enqueued, using a MongoDB change stream on the add queue.
+
+    Change streams need a replica set; on a standalone server this falls back to polling every
+    `add-queue-poll-interval` seconds.
+    """
+    while True:
+        try:
+            watch()
+        except OperationFailure as e:
+            logging.warning(f"Change streams unavailable for the add queue, polling instead. Error: {e}")
+            break
+        except PyMongoError as e:
+            logging.error(f"Add queue change stream failed, reopening. Error: {e}")
+            time.sleep(config.add_queue_poll_interval)
+
+    while True:
+        next_flush = run_cron()
+        delay = config.add_queue_poll_interval
+        if next_flush is not None:
+            delay = min(delay, max(0.0, (next_flush - add_queue.now()).total_seconds()))
+        time.sleep(delay)
@@ -1,37 +1,104 @@
-import time
+import logging
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from bson import ObjectId
 
 from configuration import Config
+from minute_tasks.add_client import inbound_lease
 from models.server import Server
+from utilities.api_call import PanelError
+from utilities.job_queue import JobQueue
 
 config = Config()
 servers_db = config.get_db().servers
 delete_queue_db = config.get_db().delete_queue
+delete_queue = JobQueue(delete_queue_db)
+add_queue_db = config.get_db().add_queue
+executor = ThreadPoolExecutor(max_workers=config.delete_workers, thread_name_prefix='delete-client')
 
 def add_job(uuid: str, server: ObjectId) -> bool:
-    delete_queue_db.insert_one({'uuid': uuid, 'server': server})
+    """
+    Enqueue deleting a client from a server, coalesced with the jobs still waiting for the same
+    client: an add that never reached the panel is cancelled instead, and a second delete is
+    dropped.
+
+    Only unclaimed jobs (no owner) are coalesced, so a job a worker is running is never changed.
+    """
+    key = {'server': server, 'uuid': uuid, 'owner': None}
+    pending_add = add_queue_db.find_one_and_delete(key)
+    if pending_add and pending_add.get('op', 'add') == 'add' and not pending_add.get('attempts'):
+        logging.info(f"Cancelled pending add of client {uuid} on server: {server}")
+        return True
+    if not delete_queue_db.find_one(key):
+        delete_queue.put({'uuid': uuid, 'server': server})
     return True
 
+def delete_clients(server: Server, jobs: list) -> list:
+    """
+    Delete the clients of a server's jobs and return the IDs of the jobs that are done. Jobs the
+    panel rejects are dead-lettered; when the panel is unavailable, the jobs not done are given
+    back to the queue.
+    """
+    # The bulk path rewrites the whole client list, which would drop clients the add worker adds
+    # meanwhile; it holds the server's inbound lease, which the add worker takes before adding.
+    lease = inbound_lease(server.mongo_id)
+    if config.delete_bulk_threshold and len(jobs) >= config.delete_bulk_threshold and lease.acquire():
+        try:
+            server.delete_clients_bulk([job['uuid'] for job in jobs])
+            return [job['_id'] for job in jobs]
+        except Exception as e:
+            logging.error(f"Failed to bulk delete {len(jobs)} clients from server: {server.mongo_id}. Error: {e}")
+            if not isinstance(e, PanelError) or e.transient:
+                for job in jobs:
+                    delete_queue.release(job, str(e))
+                return []
+            # Rejected: delete one by one so only the offending jobs are dead-lettered
+        finally:
+            lease.release()
+
+    done = []
+    for index, job in enumerate(jobs):
+        try:
+            server.delete_client(job['uuid'])
+        except Exception as e:
+            logging.error(f"Failed to delete client {job['uuid']} from server: {server.mongo_id}. Error: {e}")
+            if isinstance(e, PanelError) and not e.transient:
+                delete_queue.dead_letter(job, str(e))
+                done.append(job['_id'])
+                continue
+            # The panel is failing, give the rest of the server's jobs back as well
+            for pending in jobs[index:]:
+                delete_queue.release(pending, str(e))
+            return done
+        done.append(job['_id'])
+
+    return done
+
 def cron():
-    # Fetch all jobs from the delete queue
-    current_queue = list(delete_queue_db.find({}))
+    # Claim the jobs of the delete queue
+    current_queue = delete_queue.claim_many(config.queue_claim_limit)
+    if not current_queue:
+        return
 
     # Group jobs by server
     jobs_by_server = defaultdict(list)
     for job in current_queue:
         jobs_by_server[job['server']].append(job)
 
-    for server_id, jobs in jobs_by_server.items():
-        # Fetch the server associated with these jobs
-        server_data = servers_db.find_one({'_id': server_id})
-        if server_data:
-            server = Server.model_validate(server_data)
-
-            # Delete clients associated with this server
-            for job in jobs:
-                server.delete_client(job['uuid'])
-                # Remove the job from the queue immediately after processing
-                delete_queue_db.delete_one({'_id': job['_id']})
-                time.sleep(0.2)  # Sleep between client deletions
+    servers = {data['_id']: Server.model_validate(data)
+               for data in servers_db.find({'_id': {'$in': list(jobs_by_server.keys())}})}
+
+    done = []
+    for server_id in jobs_by_server.keys() - servers.keys():
+        # Nothing left to delete from a server that no longer exists
+        logging.warning(f"Dropping {len(jobs_by_server[server_id])} delete jobs of missing server: {server_id}")
+        done.extend(job['_id'] for job in jobs_by_server[server_id])
+
+    # Servers are processed in parallel, clients of one server one after another
+    futures = [executor.submit(delete_clients, server, jobs_by_server[server_id])
+               for server_id, server in servers.items()]
+    for future in futures:
+        done.extend(future.result())
+
+    delete_queue.ack(done)
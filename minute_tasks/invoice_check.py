@@ -5,17 +5,17 @@ from typing import Optional
 
 import httpx
 from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton
-from motor.motor_asyncio import AsyncIOMotorClient
 
 from configuration import Config
 from models.invoice import InvoiceResponse
+from utilities.job_queue import AsyncJobQueue
 
 config = Config()
 
-# Initialize an async MongoDB client
-client = AsyncIOMotorClient(config.mongo_uri)['xui']
+# The process-wide async MongoDB client's database
+client = config.get_async_db()
 invoices_db = client.invoices
-invoices_queue = client.invoice_queue
+invoices_queue = AsyncJobQueue(client.invoice_queue)
 users = client.users
 
 API_ENDPOINT = "https://api.cryptomus.com/v1/payment/info"
@@ -32,7 +32,7 @@ async def add_job(order_id, user_data) -> bool:
     Returns:
         bool: True if the job was added successfully, otherwise False.
     """
-    await invoices_queue.insert_one({'order_id': order_id, 'user_data': user_data})
+    await invoices_queue.put({'order_id': order_id, 'user_data': user_data})
     return True
 
 
@@ -159,15 +159,20 @@ async def cron_job(bot: Bot):
             money = int(final_invoice.additional_data)
             user_id = int(final_invoice.order_id.split('_')[0])
             status = final_invoice.payment_status in ['paid', 'paid_over']
-            invoice = await invoices_queue.find_one({'order_id': final_invoice.order_id})
+            # Claiming the job makes sure only one worker credits the balance
+            invoice = await invoices_queue.claim({'order_id': final_invoice.order_id})
+            if not invoice:
+                continue
 
-            if invoice and status:
+            if status:
+                await users.update_one({'_id': user_id}, {'$inc': {'balance': money}})
+            await invoices_queue.ack([invoice['_id']])
+
+            if status:
                 await send_notification(bot.bot, user_id, money, invoice['user_data'])
                 try:
                     await send_notification(bot.bot, config.admin, money, {})
                 except:
                     continue
-                await users.update_one({'_id': user_id}, {'$inc': {'balance': money}})
             else:
-                await send_expired_notification(bot.bot, user_id, invoice['uuid'])
-            await invoices_queue.delete_one({'order_id': final_invoice.order_id})
+                await send_expired_notification(bot.bot, user_id, final_invoice.order_id)
@@ -1,14 +1,16 @@
 import httpx
 from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton
-from motor.motor_asyncio import AsyncIOMotorClient
 from configuration import Config
+from utilities.job_queue import AsyncJobQueue, JobQueue
 
 # Initialize configuration
 config = Config()
 
-# Initialize an asynchronous MongoDB client and select the database and collection
-client = AsyncIOMotorClient(config.mongo_uri)['xui']
-notifications_queue = client.notifications_queue  # Ensure the collection name is correct
+# The process-wide asynchronous MongoDB client's database
+client = config.get_async_db()
+notifications_queue = AsyncJobQueue(client.notifications_queue)  # Ensure the collection name is correct
+# The same queue for synchronous producers
+notifications_queue_sync = JobQueue(config.get_db().notifications_queue)
 
 # Define a keyboard layout for the messages
 keyboard = [[InlineKeyboardButton("🖥️ پنل", callback_data="menu")]]
@@ -27,13 +29,32 @@ async def add_job(text, user_id) -> bool:
         bool: True if the operation was successful, False otherwise.
     """
     try:
-        await notifications_queue.insert_one({'content': text, 'user_id': user_id})
+        await notifications_queue.put({'content': text, 'user_id': user_id})
         return True
     except Exception as e:
         print(f"Failed to add job: {e}")  # Logging the exception can help in debugging
         return False
 
 
+def add_job_sync(text, user_id) -> bool:
+    """
+    Adds a notification job to the queue from synchronous code, e.g. the usage updater threads.
+
+    Args:
+        text (str): The notification message content.
+        user_id (int): The Telegram user ID to send the notification to.
+
+    Returns:
+        bool: True if the operation was successful, False otherwise.
+    """
+    try:
+        notifications_queue_sync.put({'content': text, 'user_id': user_id})
+        return True
+    except Exception as e:
+        print(f"Failed to add job: {e}")
+        return False
+
+
 async def cron(bot: Bot):
     """
     The cron job that iterates through the notification queue, sends notifications,
@@ -43,7 +64,7 @@ async def cron(bot: Bot):
         bot (Bot): The Telegram Bot instance used for sending messages.
     """
     try:
-        current_queue = await notifications_queue.find().to_list(None)  # Retrieve all jobs from the queue
+        current_queue = await notifications_queue.claim_many(config.queue_claim_limit)  # Claim jobs from the queue
     except Exception as e:
         print(f"Failed to retrieve notification queue: {e}")
         return
@@ -54,9 +75,10 @@ async def cron(bot: Bot):
             await bot.bot.send_message(notification['user_id'], text=notification['content'],
                                     reply_markup=reply_markup, parse_mode='Markdown')
             # Remove the notification from the queue after successful sending
-            await notifications_queue.delete_one({'_id': notification['_id']})
+            await notifications_queue.ack([notification['_id']])
         except Exception as e:
             print(f"Failed to send notification or delete from queue: {e}")
-            # Optionally, log the failed notification for retry or review
+            # Give it back to the queue to be retried later or dead-lettered
+            await notifications_queue.release(notification, str(e))
             continue
 
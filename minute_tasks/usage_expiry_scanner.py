@@ -1,4 +1,5 @@
 import datetime
+import logging
 
 from configuration import Config
 from minute_tasks import delete_client
@@ -8,16 +9,29 @@ config = Config()
 subscriptions_db = config.get_db().subscriptions
 
 
+def backfill_remaining() -> int:
+    """
+    Set `remaining` (traffic - usage) on subscriptions stored before the field existed.
+
+    Returns:
+        int: Number of subscriptions updated.
+    """
+    result = subscriptions_db.update_many(
+        {'remaining': {'$exists': False}},
+        [{'$set': {'remaining': {'$subtract': ['$traffic', '$usage']}}}]
+    )
+    if result.modified_count:
+        logging.info(f"Backfilled remaining traffic of {result.modified_count} subscriptions")
+    return result.modified_count
+
+
 def cron():
-    expired_subscriptions = list(subscriptions_db.find({
-        'active': True,
-        '$or': [
-            {'expiry_time': {'$lte': datetime.datetime.now()}},
-            {'$expr': {'$gt': ['$usage', '$traffic']}}
-        ]
-    }))
-
-    for subscription_data in expired_subscriptions:
+    # Two index range queries (active, expiry_time) and (active, remaining) instead of one scan
+    expired = subscriptions_db.find({'active': True, 'expiry_time': {'$lte': datetime.datetime.now()}})
+    exhausted = subscriptions_db.find({'active': True, 'remaining': {'$lt': 0}})
+    expired_subscriptions = {data['_id']: data for cursor in (expired, exhausted) for data in cursor}
+
+    for subscription_data in expired_subscriptions.values():
         subscription = Subscription.model_validate(subscription_data)
         for server in subscription.servers.keys():
             delete_client.add_job(str(subscription.mongo_id), server)
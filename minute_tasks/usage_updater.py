@@ -1,20 +1,259 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 from telegram import helpers
 
 from configuration import Config
 from models.server import Server
 import logging
 
-from minute_tasks.send_notification import add_job
-from models.subscription import Subscription
+from minute_tasks.send_notification import add_job_sync
+from utilities import subscription_layout
+from utilities.leader import LeaderLease
+from utilities.partition import Membership
 
 config = Config()
 subscriptions_db = config.get_db().subscriptions
 servers_db = config.get_db().servers
+usage_counters_db = config.get_db().usage_counters  # Last seen panel counters per (server, email)
+
+executor = ThreadPoolExecutor(max_workers=config.usage_updater_workers, thread_name_prefix='usage-updater')
+# Servers whose previous update is still running; they are skipped until it finishes so the
+# same counters are never read and reset twice.
+in_flight = set()
+in_flight_lock = threading.Lock()
+# Per-server polling schedule: monotonic start of the last poll, time of the next poll, and the
+# current interval in seconds
+last_poll: Dict[object, float] = {}
+next_poll: Dict[object, float] = {}
+poll_intervals: Dict[object, float] = {}
+
+
+def counter_deltas(server: Server, clients: list) -> Tuple[Dict[str, int], Dict[str, UpdateOne]]:
+    """
+    Compute the bytes each of a server's clients used since the last time their cumulative panel
+    counters were seen, in one read.
+
+    A counter lower than the stored one means it was reset on the panel (client re-added, manual
+    reset, panel database restored), in which case everything counted since is new usage.
+
+    Returns:
+        tuple: The deltas by email, and by email the writes storing the new counters, to apply
+            with save_counters() once the usage is added to the subscriptions.
+    """
+    emails = [client['email'] for client in clients]
+    previous = {counter['email']: counter for counter in
+                usage_counters_db.find({'server': server.mongo_id, 'email': {'$in': emails}})}
+
+    deltas, operations = {}, {}
+    for client in clients:
+        up, down = client.get('up', 0), client.get('down', 0)
+        last = previous.get(client['email'], {})
+        delta = 0
+        for key, current in (('up', up), ('down', down)):
+            last_value = last.get(key, 0)
+            delta += current - last_value if current >= last_value else current
+        deltas[client['email']] = delta
+        if last.get('up') != up or last.get('down') != down:
+            operations[client['email']] = UpdateOne({'server': server.mongo_id, 'email': client['email']},
+                                                    {'$set': {'up': up, 'down': down}}, upsert=True)
+    return deltas, operations
+
+
+def save_counters(operations: List[UpdateOne]):
+    """
+    Store the counters returned by counter_deltas() in one bulk write.
+    """
+    if operations:
+        usage_counters_db.bulk_write(operations, ordered=False)
+
+
+def client_usages(server: Server, clients: list) -> Tuple[Dict[str, float], Dict[str, UpdateOne]]:
+    """
+    Usage of a server's clients since the previous cycle in gigabytes, by email, and the counter
+    writes to save once it is stored (see counter_deltas).
+    """
+    if config.usage_accounting == 'delta':
+        deltas, counters = counter_deltas(server, clients)
+        return {email: delta / (1024 ** 3) for email, delta in deltas.items()}, counters
+    # Use .get() for safe access with a default value of 0 if not found
+    return {client['email']: (client.get('up', 0) + client.get('down', 0)) / (1024 ** 3) for client in clients}, {}
+
+
+def next_interval(server_id, usage: float, elapsed: float, near_limit: bool) -> float:
+    """
+    Seconds until a server is polled again.
+
+    Servers with a subscription close to its quota or with fast-growing counters are polled at
+    the minimum interval so quotas are enforced quickly; servers that had no usage back off
+    exponentially up to the maximum interval; everything else is polled at the base interval.
+
+    Args:
+        server_id: ID of the server.
+        usage (float): Gigabytes used since the previous poll.
+        elapsed (float): Seconds since the previous poll.
+        near_limit (bool): Whether a subscription with usage is close to its quota.
+    """
+    rate = usage * 1024 / elapsed if elapsed else 0.0  # MB/s
+    if near_limit or rate >= config.usage_poll_fast_rate:
+        return config.usage_poll_min_interval
+    if not usage:
+        previous = poll_intervals.get(server_id, config.usage_poll_base_interval)
+        return min(config.usage_poll_max_interval, previous * 2)
+    return config.usage_poll_base_interval
+
+
+def update_server(server: Server, deadline: Optional[float] = None,
+                  lease: Optional[LeaderLease] = None) -> Optional[tuple]:
+    """
+    Collect the usage of a server's clients and add it to their subscriptions.
+
+    The update is abandoned, before the panel's counters are reset or the stored ones advanced,
+    once the deadline has passed or the server's lease can't be renewed; the server is read again
+    on the next cycle.
+
+    Args:
+        server (Server): The server to update.
+        deadline (float, optional): time.monotonic() value after which the update is abandoned.
+        lease (LeaderLease, optional): The server's usage lease, renewed before the counters change.
+
+    Returns:
+        Optional[tuple]: Gigabytes used on the server and whether a subscription with usage is
+            close to its quota, None if the panel couldn't be read.
+    """
+    try:
+        clients = server.get_clients(deadline=deadline)
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError(f'reading the clients took longer than {config.usage_updater_deadline} seconds')
+        if lease and not lease.acquire():
+            raise RuntimeError('the usage lease was taken over by another worker')
+        if config.usage_accounting != 'delta':
+            server.reset_traffic()
+    except Exception as e:
+        logging.error(f"Server operation failed for {server.mongo_id}: {e}")
+        return None  # Skip the server if there's a network-related issue
 
+    clients = [client for client in clients if client.get('email')]
+    try:
+        usages, counters = client_usages(server, clients)
+        usages = {email: usage for email, usage in usages.items() if usage}
+        if not usages:
+            save_counters(list(counters.values()))
+            return 0.0, False
+    except Exception as e:
+        logging.error(f"Failed to read usage counters for server {server.mongo_id}: {e}")
+        return None
 
-def cron():
+    # One query for the subscriptions of every client with usage, one bulk write for the increments
+    # of the migrated ones
+    subscriptions = {}
+    projection = {'servers': 1, 'traffic': 1, 'usage': 1, 'name': 1, 'user_id': 1}
+    for subscription in subscriptions_db.find(subscription_layout.server_filter(server.mongo_id, list(usages)),
+                                              projection):
+        entry = subscription_layout.from_document(subscription['servers']).get(server.mongo_id)
+        if entry:
+            subscriptions[entry[0]] = subscription
+
+    total, near_limit, operations, emails, unsaved = 0.0, False, [], [], set()
+    for email, usage in usages.items():
+        total += usage
+        subscription = subscriptions.get(email)
+        if not subscription:
+            continue
+        try:
+            traffic, used = subscription['traffic'], subscription['usage']
+            near_limit |= traffic - (used + usage) <= traffic * config.usage_poll_near_limit
+            # Warn once, on the cycle that crosses 10% remaining
+            if traffic - used >= traffic * 0.1 >= traffic - (used + usage):
+                add_job_sync(f'⚠ کاربر گرامی، کمتر از **ده‌درصد** حجم خریداری شده اشتراک  `{helpers.escape_markdown(subscription["name"], version=2)}`   باقی مانده.', subscription['user_id'])
+        except Exception as e:
+            logging.error(f"Error checking the traffic of subscription {subscription['_id']}: {e}")
+        inc = {'usage': usage, 'remaining': -usage}
+        if subscription_layout.is_migrated(subscription):
+            operations.append(subscription_layout.usage_operation(subscription, server.mongo_id, email, usage, inc))
+            emails.append(email)
+            continue
+        # Still in the old layout: written on its own so a conversion since the read is followed
+        try:
+            if not subscription_layout.add_usage(subscription, server.mongo_id, email, usage, inc):
+                logging.warning(f"Client {email} left subscription {subscription['_id']} before its usage was added")
+        except Exception as e:
+            unsaved.add(email)
+            logging.error(f"Error updating usage of client {email} on server {server.mongo_id}: {e}")
+
+    # The counters of a client are only saved once its usage is stored, so usage that couldn't be
+    # written is counted again on the next cycle instead of being lost.
+    if operations:
+        try:
+            subscriptions_db.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            unsaved |= {emails[error['index']] for error in e.details['writeErrors']}
+            logging.error(f"Error updating usage of {len(unsaved)} clients on server {server.mongo_id}: {e}")
+        except Exception as e:
+            unsaved |= set(emails)
+            logging.error(f"Error updating usage of {len(operations)} clients on server {server.mongo_id}: {e}")
+    try:
+        save_counters([operation for email, operation in counters.items() if email not in unsaved])
+    except Exception as e:
+        logging.error(f"Failed to save usage counters for server {server.mongo_id}: {e}")
+
+    return total, near_limit
+
+
+def run_server(server: Server):
+    # While workers rebalance, or a new leader replica takes over from one whose updates are
+    # still running, two processes may briefly both own a server; the per-server lease makes
+    # sure only one polls it.
+    lease = LeaderLease(f'usage:{server.mongo_id}', config.usage_server_lease_seconds)
+    try:
+        if not lease.acquire():
+            logging.info(f"Server {server.mongo_id} is being updated by another worker, skipping")
+            return
+        started = time.monotonic()
+        result = update_server(server, started + config.usage_updater_deadline, lease)
+        if result is not None:
+            usage, near_limit = result
+            elapsed = started - last_poll.get(server.mongo_id, started - config.usage_poll_base_interval)
+            interval = next_interval(server.mongo_id, usage, elapsed, near_limit)
+            last_poll[server.mongo_id] = started
+            poll_intervals[server.mongo_id] = interval
+            next_poll[server.mongo_id] = started + interval
+    except Exception as e:
+        logging.error(f"Usage update failed for server {server.mongo_id}: {e}")
+    finally:
+        if lease.is_leader:
+            lease.release()
+        with in_flight_lock:
+            in_flight.discard(server.mongo_id)
+
+
+def cron(membership: Optional[Membership] = None):
+    """
+    Collect the usage of every server that is due (see next_interval), or only of the due servers
+    this worker owns when a membership is given (see usage_worker.py).
+
+    Args:
+        membership (Membership, optional): Group of usage workers partitioning the servers.
+    """
     servers = list(servers_db.find({}))
+    if membership:
+        owned = set(membership.partition(server['_id'] for server in servers))
+        servers = [server for server in servers if server['_id'] in owned]
+
+    # Forget the schedule of servers that were removed or moved to another worker
+    ids = {server['_id'] for server in servers}
+    for schedule in (last_poll, next_poll, poll_intervals):
+        for server_id in schedule.keys() - ids:
+            schedule.pop(server_id, None)
+
+    now = time.monotonic()
+    servers = [server for server in servers if next_poll.get(server['_id'], 0) <= now]
 
+    futures = []
     for server_dict in servers:
         try:
             server = Server.model_validate(server_dict)
@@ -22,36 +261,18 @@ def cron():
             logging.error(f"Error validating server {server_dict.get('_id', 'unknown')}: {e}")
             continue  # Skip to the next server if validation fails
 
-        try:
-            clients = server.get_clients()
-            server.reset_traffic()
-        except Exception as e:
-            logging.error(f"Server operation failed for {server.mongo_id}: {e}")
-            continue  # Skip to the next server if there's a network-related issue
-
-        for client in clients:
-            try:
-                # Use .get() for safe access with a default value of 0 if not found
-                usage = (client.get('up', 0) + client.get('down', 0)) / (1024 ** 3)
-                subscription_data = subscriptions_db.find_one({f'servers.{server.mongo_id}': client['email']})
-                if subscription_data:
-                    try:
-                        subscription = Subscription.model_validate(subscription_data)
-                        # Check if subscription usage is within expected limits before proceeding
-                        if subscription.traffic - subscription.usage >= subscription.traffic * 0.1 >= subscription.traffic - (subscription.usage + usage):
-                            add_job(f'⚠ کاربر گرامی، کمتر از **ده‌درصد** حجم خریداری شده اشتراک  `{helpers.escape_markdown(subscription.name, version=2)}`   باقی مانده.', subscription.user_id)
-                    except Exception as e:
-                        logging.error(f"Error validating subscription data: {e}")
-
-                subscriptions_db.update_one(
-                    {f'servers.{server.mongo_id}': client['email']},
-                    {'$inc': {
-                        f'servers.{server.mongo_id}.1': usage,
-                        'usage': usage
-                    }}
-                )
-            except KeyError as e:
-                logging.warning(f"Missing key {e} in client data for server {server.mongo_id}")
-            except Exception as e:
-                logging.error(
-                    f"Error updating usage for client {client.get('email', 'unknown')} on server {server.mongo_id}: {e}")
+        with in_flight_lock:
+            if server.mongo_id in in_flight:
+                logging.warning(f"Previous usage update for server {server.mongo_id} is still running, skipping")
+                continue
+            in_flight.add(server.mongo_id)
+
+        futures.append(executor.submit(run_server, server))
+
+    # Updates are abandoned at their deadline (see update_server), so this waits at most one
+    # deadline per round of workers; a server still running after it holds its lease and is
+    # skipped while in flight.
+    rounds = -(-len(futures) // config.usage_updater_workers)
+    _, running = wait(futures, timeout=rounds * config.usage_updater_deadline)
+    if running:
+        logging.warning(f"{len(running)} usage updates still running after {rounds * config.usage_updater_deadline} seconds")
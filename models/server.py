@@ -1,13 +1,19 @@
 import json
+import time
 from ipaddress import IPv4Address
+from typing import Optional, Tuple
 
 from bson import ObjectId
 from pydantic import BaseModel, Field, constr
 from pydantic.v1 import validator
 
 from configuration import Config
-from utilities.api_call import (add_clients, get_client, get_inbound,
-                                remove_client, reset_inbound_traffic)
+from utilities.api_call import (PanelError, add_clients,
+                                check_response, edit_client, get_client,
+                                get_inbound, get_inbounds, remove_client,
+                                reset_client_traffic, reset_inbound_traffic, update_inbound)
+from utilities import async_api_call, inbound_cache, retry
+from utilities.panel_health import PanelHealth, get_health
 from utilities.share import generate_vless_link, generate_vmess_link
 
 config = Config()
@@ -32,8 +38,11 @@ class Server(BaseModel):
     Methods:
         validate_port(v): Validates the panel port.
         get_link(data, uuid): Generates a link based on the protocol.
+        get_clients(bulk): Gets the traffic of every client of the inbound.
         id: Property to access the MongoDB ID.
         url: Constructs and returns the URL.
+        session: The shared panel session of the server.
+        health: The panel's health and circuit breaker state.
 
     """
     mongo_id: ObjectId = Field(default_factory=ObjectId, alias="_id")
@@ -100,6 +109,16 @@ class Server(BaseModel):
         """
         return f"{self.scheme}://{self.ip_address}:{self.panel_port}"
 
+    @property
+    def health(self) -> PanelHealth:
+        """
+        The rolling health and circuit breaker state of the server's panel.
+
+        Returns:
+            PanelHealth: The health shared by every session of the panel.
+        """
+        return get_health(self.url)
+
     def reset_traffic(self):
         """
         Resets the traffic for the server.
@@ -108,44 +127,250 @@ class Server(BaseModel):
 
     def add_client(self, data: list):
         """
-        Adds a client to the server.
+        Adds clients to the server, retrying transient failures.
+
+        Adding is idempotent: when the panel rejects the batch because some clients already
+        exist, only the missing ones are added again. A client counts as existing only if the
+        panel has its email with the same ID.
 
         Args:
             data (list): The list containing client data.
 
         Returns:
-            str: The generated link.
+            httpx.Response: The panel's response.
+
+        Raises:
+            PanelError: If the panel rejects the clients, or if some of their emails belong to
+                clients with another ID on the panel.
         """
-        return add_clients(self.url, self.panel_username, self.panel_password, self.inbound_id, data)
+        def add(clients):
+            return check_response(add_clients(self.url, self.panel_username, self.panel_password,
+                                              self.inbound_id, clients))
+
+        try:
+            return retry.policies['add_clients'].call(add, data)
+        except PanelError as e:
+            if 'duplicate' not in str(e).lower():
+                raise
+        existing = {client['email']: client['id'] for client in json.loads(self.get_inbound()['settings'])['clients']}
+        missing = [client for client in data if client['email'] not in existing]
+        conflicts = [client['email'] for client in data
+                     if client['email'] in existing and existing[client['email']] != client['id']]
+        response = retry.policies['add_clients'].call(add, missing) if missing else None
+        if conflicts:
+            raise PanelError(f"Emails already used by other clients: {', '.join(conflicts)}")
+        return response
 
     def delete_client(self, uuid):
         """
-        Deletes a client from the server.
+        Deletes a client from the server, retrying transient failures. A client that is already
+        gone counts as deleted.
 
         Args:
             uuid (str): The UUID of the client to delete.
+
+        Raises:
+            PanelError: If the panel refuses to delete the client.
         """
-        return remove_client(self.url, self.panel_username, self.panel_password, self.inbound_id, uuid)
+        def remove():
+            return check_response(remove_client(self.url, self.panel_username, self.panel_password,
+                                                self.inbound_id, uuid))
+
+        try:
+            return retry.policies['remove_client'].call(remove)
+        except PanelError as e:
+            if 'not found' not in str(e).lower():
+                raise
 
-    def get_clients(self):
+    def delete_clients_bulk(self, uuids: list):
         """
-        Gets all clients from the server.
+        Deletes many clients with a single rewrite of the inbound's settings instead of one
+        request per client.
+
+        Not safe while clients are being added: a client added between reading and rewriting the
+        settings is lost. Callers must hold the server's inbound lease (see
+        minute_tasks.add_client.inbound_lease), which the add worker takes before adding.
+
+        Args:
+            uuids (list): The UUIDs of the clients to delete.
+
+        Raises:
+            PanelError: If the panel rejects the new settings.
+        """
+        inbound = self.get_inbound()
+        settings = json.loads(inbound['settings'])
+        uuids = set(uuids)
+        settings['clients'] = [client for client in settings['clients'] if client['id'] not in uuids]
+        inbound['settings'] = json.dumps(settings)
+        inbound.pop('clientStats', None)
+        return check_response(update_inbound(self.url, self.panel_username, self.panel_password,
+                                             self.inbound_id, inbound))
+
+    def edit_client(self, uuid, data: dict):
+        """
+        Replaces a client's settings on the server, retrying transient failures.
+
+        Args:
+            uuid (str): The UUID of the client to edit.
+            data (dict): The new client data.
+
+        Raises:
+            PanelError: If the panel rejects the edit.
+        """
+        def edit():
+            return check_response(edit_client(self.url, self.panel_username, self.panel_password,
+                                              self.inbound_id, uuid, data))
+
+        return retry.policies['edit_client'].call(edit)
+
+    def reset_client_traffic(self, email: str):
+        """
+        Resets the up and down counters of a single client, retrying transient failures.
+
+        Args:
+            email (str): The email of the client.
+
+        Raises:
+            PanelError: If the panel refuses the reset.
+        """
+        def reset():
+            return check_response(reset_client_traffic(self.url, self.panel_username, self.panel_password,
+                                                       self.inbound_id, email))
+
+        return retry.policies['reset_client_traffic'].call(reset)
+
+    def get_inbound(self) -> dict:
+        """
+        Gets the inbound of the server.
 
         Returns:
-            list: The list of clients.
+            dict: The inbound object returned by the panel.
         """
         response = get_inbound(self.url, self.panel_username,
                                self.panel_password, self.inbound_id)
-        data = response.json()['obj']
-        settings = json.loads(data['settings'])
-        clients_data = settings['clients']
-        clients = []
-        for client in clients_data:
-            data = get_client(self.url, self.panel_username, self.panel_password, client['email'])
+        return response.json()['obj']
+
+    @property
+    def inbound_cache_key(self) -> tuple:
+        """
+        Key of the server's inbound in utilities.inbound_cache. It includes the panel URL and the
+        inbound ID so changing either never serves stale settings.
+        """
+        return self.mongo_id, self.url, self.inbound_id
+
+    def get_link_settings(self) -> dict:
+        """
+        Gets the inbound fields needed for link generation, from the cache when possible.
+
+        Returns:
+            dict: The protocol, port, streamSettings and sniffing of the inbound.
+        """
+        settings = inbound_cache.get(self.inbound_cache_key)
+        if settings is None:
+            settings = inbound_cache.put(self.inbound_cache_key, self.get_inbound())
+        return settings
+
+    def invalidate_link_settings(self):
+        """
+        Drops the cached inbound settings of the server, e.g. after it was edited.
+        """
+        inbound_cache.invalidate(self.mongo_id)
+
+    def find_inbound(self, inbounds: Optional[list]) -> Optional[dict]:
+        """
+        Picks the server's inbound out of the panel's inbound list.
+
+        Args:
+            inbounds (list): The inbound objects returned by the panel's list endpoint.
+
+        Returns:
+            Optional[dict]: The server's inbound, None if the panel doesn't list it.
+        """
+        return next((inbound for inbound in inbounds or [] if inbound.get('id') == self.inbound_id), None)
+
+    def get_listed_inbound(self) -> dict:
+        """
+        Gets the server's inbound from the panel's inbound list, which unlike the single inbound
+        endpoint carries the `clientStats` of every client. Falls back to the single inbound
+        endpoint if the list doesn't contain it.
+
+        Returns:
+            dict: The inbound object returned by the panel.
+        """
+        response = get_inbounds(self.url, self.panel_username, self.panel_password)
+        return self.find_inbound(response.json()['obj']) or self.get_inbound()
+
+    @staticmethod
+    def split_client_stats(inbound: dict, bulk: bool) -> Tuple[list, list]:
+        """
+        Splits the clients of an inbound into ones whose traffic is already in the inbound's
+        `clientStats` and emails that still have to be fetched one by one.
+
+        Args:
+            inbound (dict): The inbound object returned by the panel.
+            bulk (bool): Whether to use the `clientStats` of the inbound at all.
+
+        Returns:
+            tuple: The list of known clients and the list of emails left to fetch.
+        """
+        clients_data = json.loads(inbound['settings'])['clients']
+        if not bulk:
+            return [], [client['email'] for client in clients_data]
+
+        stats = {stat['email']: stat for stat in inbound.get('clientStats') or []}
+        clients = [stats[client['email']] for client in clients_data if client['email'] in stats]
+        missing = [client['email'] for client in clients_data if client['email'] not in stats]
+        return clients, missing
+
+    def get_clients(self, bulk: bool = True, deadline: Optional[float] = None):
+        """
+        Gets all clients from the server.
+
+        Args:
+            bulk (bool): Build the traffic table from the panel's inbound list response instead
+                of requesting every client's traffic separately.
+            deadline (float, optional): time.monotonic() value after which no more per-client
+                requests are sent.
+
+        Returns:
+            list: The list of clients.
+
+        Raises:
+            TimeoutError: If the deadline passed before every client was read.
+        """
+        inbound = self.get_listed_inbound() if bulk else self.get_inbound()
+        clients, missing = self.split_client_stats(inbound, bulk)
+        for index, email in enumerate(missing):
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f'{len(missing) - index} clients left to read after the deadline')
+            data = get_client(self.url, self.panel_username, self.panel_password, email)
             if data.status_code == 200:
                 clients.append(data.json()['obj'])
 
         return clients
 
+    async def get_inbound_async(self) -> dict:
+        """
+        Gets the inbound of the server without blocking the event loop.
+
+        Returns:
+            dict: The inbound object returned by the panel.
+        """
+        response = await async_api_call.get_inbound(self.url, self.panel_username, self.panel_password,
+                                                    self.inbound_id)
+        return response.json()['obj']
+
+    async def get_link_settings_async(self) -> dict:
+        """
+        Asyncio counterpart of get_link_settings.
+
+        Returns:
+            dict: The protocol, port, streamSettings and sniffing of the inbound.
+        """
+        settings = inbound_cache.get(self.inbound_cache_key)
+        if settings is None:
+            settings = inbound_cache.put(self.inbound_cache_key, await self.get_inbound_async())
+        return settings
+
     class Config:
         arbitrary_types_allowed = True
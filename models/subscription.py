@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import datetime
 import uuid
@@ -7,9 +8,9 @@ from pydantic import BaseModel, Field
 from typing import Dict, Tuple, List, Type, Optional, Any, Union
 
 from models.server import Server
-from utilities.api_call import generate_client, get_inbound
+from utilities.api_call import generate_client
 from utilities.unique_generators import generate_unique_email, generate_unique_uuid
-from utilities import share
+from utilities import share, subscription_layout
 from minute_tasks.add_client import add_job
 from configuration import Config
 
@@ -31,7 +32,8 @@ class Subscription(BaseModel):
     product: ObjectId
     servers: Dict[ObjectId, Tuple[str, float]] = Field(default_factory=dict,
                                                        description="A dictionary with ObjectId keys and Tuple of ("
-                                                                   "str, float) values")
+                                                                   "str, float) values, stored in the layout of "
+                                                                   "utilities.subscription_layout")
     traffic: float
     usage: float = 0.0
     user_id: int
@@ -76,29 +78,54 @@ class Subscription(BaseModel):
 
         return True
 
-    def get_links(self) -> Dict[ObjectId, str]:
+    def get_servers(self) -> List[Server]:
         server_ids = [ObjectId(x) for x in self.servers.keys()]
-        servers = [Server.model_validate(data) for data in servers_db.find({'_id': {'$in': server_ids}})]
+        return [Server.model_validate(data) for data in servers_db.find({'_id': {'$in': server_ids}})]
 
+    def generate_link(self, server: Server, inbound: dict) -> Optional[str]:
+        if inbound['protocol'] == 'vmess':
+            return share.generate_vmess_link(inbound, server.connect_domain, f'{self.mongo_id}',
+                                             f'{self.name} {server.name}')
+        if inbound['protocol'] == 'vless':
+            return share.generate_vless_link(inbound, server.connect_domain, f'{self.mongo_id}',
+                                             f'{self.name} {server.name}')
+        return None
+
+    def get_links(self) -> Dict[ObjectId, str]:
         links = {}
-        for server in servers:
-            response = get_inbound(server.url, server.panel_username, server.panel_password, server.inbound_id)
-            response = response.json()['obj']
-            del response['settings']
+        for server in self.get_servers():
+            link = self.generate_link(server, server.get_link_settings())
+            if link:
+                links[server.mongo_id] = link
 
-            if response['protocol'] == 'vmess':
-                links[server.mongo_id] = share.generate_vmess_link(response, server.connect_domain, f'{self.mongo_id}',
-                                                                   f'{self.name} {server.name}')
-            if response['protocol'] == 'vless':
-                links[server.mongo_id] = share.generate_vless_link(response, server.connect_domain, f'{self.mongo_id}',
-                                                                   f'{self.name} {server.name}')
+        return links
+
+    async def get_links_async(self) -> Dict[ObjectId, str]:
+        """
+        Asyncio counterpart of get_links, querying every server's panel concurrently.
+        """
+        servers = self.get_servers()
+        inbounds = await asyncio.gather(*[server.get_link_settings_async() for server in servers])
+
+        links = {}
+        for server, inbound in zip(servers, inbounds):
+            link = self.generate_link(server, inbound)
+            if link:
+                links[server.mongo_id] = link
 
         return links
 
     def get_links_message(self) -> str:
+        return self.format_links_message(self.get_links())
+
+    async def get_links_message_async(self) -> str:
+        return self.format_links_message(await self.get_links_async())
+
+    @staticmethod
+    def format_links_message(links: Dict[ObjectId, str]) -> str:
         text = ''
 
-        for server_id, link in self.get_links().items():
+        for server_id, link in links.items():
             server = Server.model_validate(servers_db.find_one({'_id': ObjectId(server_id)}))
             text += f'`{link}`\n{server.name}\n\n'
 
@@ -106,7 +133,10 @@ class Subscription(BaseModel):
 
     def model_dump(self, **kwargs):
         output = super().model_dump(**kwargs)
-        output['servers'] = {str(key): value for key, value in self.servers.items()}
+        output['servers'] = subscription_layout.to_document(self.servers)
+        # Stored so usage_expiry_scanner can find exhausted subscriptions with an index; usage
+        # increments keep it in step (see subscription_layout.usage_operation)
+        output['remaining'] = self.traffic - self.usage
         return output
 
     @classmethod
@@ -119,7 +149,7 @@ class Subscription(BaseModel):
         context: Union[Dict[str, Any], None] = None,
     ) -> 'Subscription':
         if isinstance(obj, dict):
-            obj['servers'] = {ObjectId(key): value for key, value in obj['servers'].items()}
+            obj['servers'] = subscription_layout.from_document(obj.get('servers'))
         return super().model_validate(obj, strict=strict, from_attributes=from_attributes, context=context)
 
     class Config:
@@ -0,0 +1,69 @@
+"""
+usage_worker.py
+---------
+Usage collection worker for large fleets. Set `usage-updater-mode: workers` so the bot stops
+collecting usage itself, then run as many workers as needed, on any number of machines:
+
+    python usage_worker.py [processes]
+
+The live workers split the servers between them by consistent hashing of the server ID and
+rebalance when a worker joins or leaves, so every panel is polled by exactly one worker.
+"""
+import asyncio
+import logging
+import multiprocessing
+import signal
+import sys
+
+from configuration import Config
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(name)s: %(asctime)s | %(levelname)s | %(filename)s:%(lineno)s | %(process)d >>> %(message)s",
+    filename="out.log",
+    filemode='a'
+)
+
+
+async def run():
+    # Everything that opens a MongoDB client or picks the worker ID is created here, after the
+    # worker processes are forked.
+    config = Config('configuration.yaml')
+    from minute_tasks import usage_expiry_scanner, usage_updater
+    from utilities.partition import Membership
+    from utilities.scheduler import Scheduler
+
+    membership = Membership('usage-updater')
+    scheduler = Scheduler(config.scheduler_workers)
+    scheduler.add_job('worker-heartbeat', membership.heartbeat, membership.ttl / 3, jitter=0)
+    scheduler.add_job('usage-updater', usage_updater.cron, config.usage_poll_min_interval, membership)
+    scheduler.add_job('scheduler-stats', scheduler.log_stats, 600)
+
+    stopped = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, stopped.set)
+
+    # Usage increments decrement `remaining`, which has to exist first
+    usage_expiry_scanner.backfill_remaining()
+    membership.heartbeat()
+    scheduler.start()
+    logging.info(f"Usage worker {membership.worker_id} started")
+    await stopped.wait()
+    await scheduler.stop()
+    membership.leave()
+
+
+def main():
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    if processes == 1:
+        main()
+    else:
+        workers = [multiprocessing.Process(target=main, name=f'usage-worker-{i}') for i in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
@@ -1,7 +1,55 @@
 import json
+import threading
+import time
 import uuid
 import httpx
 import datetime
+from typing import Dict, Tuple
+
+from utilities.panel_health import get_health
+from utilities.single_flight import SingleFlight
+
+# Identical reads against the same panel that overlap in time share one request.
+single_flight = SingleFlight()
+
+
+class PanelError(Exception):
+    """
+    Raised when a panel rejects a request.
+
+    Args:
+        message (str): The panel's error message.
+        transient (bool): Whether the failure is worth retrying, e.g. a 5xx answer.
+    """
+
+    def __init__(self, message: str, transient: bool = False):
+        super().__init__(message)
+        self.transient = transient
+
+
+def check_response(response: httpx.Response) -> httpx.Response:
+    """
+    Raise PanelError unless the panel reports success.
+
+    Only a well-formed answer with `success: false` is a rejection of the request itself; any
+    HTTP-level failure (5xx, an auth failure or redirect that survived logging in again, a wrong
+    path) says nothing about the request's content and is raised as transient.
+
+    Args:
+        response (httpx.Response): Response returned by the panel.
+
+    Returns:
+        httpx.Response: The same response if the panel reports success.
+    """
+    if not response.is_success:
+        raise PanelError(f'Panel answered {response.status_code}', transient=True)
+    try:
+        data = response.json()
+    except ValueError:
+        raise PanelError('Panel answered with a malformed body', transient=True)
+    if not data.get('success'):
+        raise PanelError(data.get('msg') or 'Unknown panel error')
+    return response
 
 
 def generate_client(totalGB, expiryTime, email, idi=None) -> dict:
@@ -30,6 +78,157 @@ def generate_client(totalGB, expiryTime, email, idi=None) -> dict:
     }
 
 
+def login_succeeded(response: httpx.Response) -> bool:
+    """
+    Whether a login response reports success; the panel answers wrong credentials with a 200.
+    """
+    try:
+        return response.is_success and bool(response.json().get('success'))
+    except ValueError:
+        return False
+
+
+class PanelSession:
+    """
+    A logged-in, keep-alive connection to a single x-ui panel.
+
+    The session cookie and the underlying connection pool are reused across calls. The panel is
+    only asked to log in again when it answers a request with an auth failure or a redirect to
+    the login page.
+
+    Args:
+        url (str): URL to the service.
+        username (str): Username for authentication.
+        password (str): Password for authentication.
+    """
+
+    def __init__(self, url: str, username: str, password: str):
+        self.url = url
+        self.username = username
+        self.password = password
+        self._client = httpx.Client(base_url=url, transport=transports.get(url))
+        self._lock = threading.Lock()
+        self._logged_in = False
+
+    def login(self) -> httpx.Response:
+        """
+        Log in to the panel and store the session cookie on the client.
+
+        Returns:
+            httpx.Response: HTTP response object of the login request.
+        """
+        with self._lock:
+            body = {
+                "username": self.username,
+                "password": self.password
+            }
+            r = self._client.post('/login', data=body)
+            self._logged_in = login_succeeded(r)
+            return r
+
+    def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """
+        Send a request to the panel, logging in first or again when needed.
+
+        The outcome is recorded in the panel's health, and the request fails fast with
+        PanelUnavailable while the panel's circuit breaker is open.
+
+        Args:
+            method (str): HTTP method.
+            path (str): Path relative to the panel URL.
+            **kwargs: Extra arguments passed to httpx.
+
+        Returns:
+            httpx.Response: HTTP response object of the request.
+        """
+        health = get_health(self.url)
+        health.before_request()
+        start = time.monotonic()
+        try:
+            if not self._logged_in:
+                self.login()
+            r = self._client.request(method, path, **kwargs)
+            if is_auth_failure(r):
+                self.login()
+                r = self._client.request(method, path, **kwargs)
+        except httpx.HTTPError:
+            health.record(False, time.monotonic() - start)
+            raise
+        except BaseException:
+            health.abandon()
+            raise
+        health.record(r.status_code < 500, time.monotonic() - start)
+        return r
+
+    def get(self, path: str, **kwargs) -> httpx.Response:
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> httpx.Response:
+        return self.request('POST', path, **kwargs)
+
+    def close(self):
+        """
+        Close the underlying connection pool.
+        """
+        self._client.close()
+        self._logged_in = False
+
+
+_sessions: Dict[Tuple[str, str, str], PanelSession] = {}
+_sessions_lock = threading.Lock()
+# Transports used instead of the network for specific panel URLs, e.g. utilities.fake_panel.
+transports: Dict[str, httpx.BaseTransport] = {}
+
+
+def is_auth_failure(response: httpx.Response) -> bool:
+    """
+    Check whether the panel rejected a request because the session is not logged in.
+
+    Args:
+        response (httpx.Response): Response returned by the panel.
+
+    Returns:
+        bool: True if the panel answered with an auth failure or a redirect.
+    """
+    return response.status_code in (401, 403) or response.is_redirect
+
+
+def get_session(url: str, username: str, password: str) -> PanelSession:
+    """
+    Get the shared session for a panel, creating it on first use.
+
+    Sessions are keyed by URL and credentials so changing a server's credentials starts a new one.
+
+    Args:
+        url (str): URL to the service.
+        username (str): Username for authentication.
+        password (str): Password for authentication.
+
+    Returns:
+        PanelSession: The session for the panel.
+    """
+    key = (url, username, password)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = PanelSession(url, username, password)
+        return session
+
+
+def close_sessions(url: str):
+    """
+    Close and forget every shared session of a panel URL, whatever its credentials.
+
+    Args:
+        url (str): URL to the service.
+    """
+    with _sessions_lock:
+        keys = [key for key in _sessions if key[0] == url]
+        sessions = [_sessions.pop(key) for key in keys]
+    for session in sessions:
+        session.close()
+
+
 def get_inbounds(url, username, password) -> httpx.Response:
     """
     Get inbounds from a specified URL using authentication.
@@ -42,14 +241,9 @@ def get_inbounds(url, username, password) -> httpx.Response:
     Returns:
         httpx.Response: HTTP response object containing the inbounds data.
     """
-    with httpx.Client() as client:
-        body = {
-            "username": username,
-            "password": password
-        }
-        client.post(url + '/login', data=body)
-        r = client.get(url + '/xui/API/inbounds/')
-        return r
+    session = get_session(url, username, password)
+    r = single_flight.do(('get_inbounds', url, username, password), session.get, '/xui/API/inbounds/')
+    return r
 
 
 def update_inbound(url, username, password, idi, data):
@@ -66,14 +260,9 @@ def update_inbound(url, username, password, idi, data):
     Returns:
         httpx.Response: HTTP response object indicating the success or failure of the update.
     """
-    with httpx.Client() as client:
-        body = {
-            "username": username,
-            "password": password
-        }
-        client.post(url + '/login', data=body)
-        r = client.post(f'{url}/xui/API/inbounds/update/{idi}', json=data)
-        return r
+    session = get_session(url, username, password)
+    r = session.post(f'/xui/API/inbounds/update/{idi}', json=data)
+    return r
 
 
 def get_inbound(url: str, username: str, password: str, idi: int) -> httpx.Response:
@@ -89,14 +278,10 @@ def get_inbound(url: str, username: str, password: str, idi: int) -> httpx.Respo
     Returns:
         httpx.Response: HTTP response object containing the specific inbound data.
     """
-    with httpx.Client() as client:
-        body = {
-            "username": username,
-            "password": password
-        }
-        client.post(url + '/login', data=body)
-        r = client.get(f'{url}/xui/API/inbounds/get/{idi}')
-        return r
+    session = get_session(url, username, password)
+    r = single_flight.do(('get_inbound', url, username, password, idi), session.get,
+                         f'/xui/API/inbounds/get/{idi}')
+    return r
 
 
 def add_clients(url, username, password, idi, users) -> httpx.Response:
@@ -113,20 +298,15 @@ def add_clients(url, username, password, idi, users) -> httpx.Response:
     Returns:
         httpx.Response: HTTP response object indicating the success or failure of the operation.
     """
-    with httpx.Client() as client:
-        body = {
-            "username": username,
-            "password": password
-        }
-        client.post(url + '/login', data=body)
-        body = {
-            "id": idi,
-            "settings": json.dumps({
-                "clients": users
-            })
-        }
-        r = client.post(url + '/xui/API/inbounds/addClient', data=body)
-        return r
+    session = get_session(url, username, password)
+    body = {
+        "id": idi,
+        "settings": json.dumps({
+            "clients": users
+        })
+    }
+    r = session.post('/xui/API/inbounds/addClient', data=body)
+    return r
 
 
 def remove_client(url, username, password, idi, _id) -> httpx.Response:
@@ -143,14 +323,9 @@ def remove_client(url, username, password, idi, _id) -> httpx.Response:
     Returns:
         httpx.Response: HTTP response object indicating the success or failure of the removal.
     """
-    with httpx.Client() as client:
-        body = {
-            "username": username,
-            "password": password
-        }
-        client.post(url + '/login', data=body)
-        r = client.post(url + f'/xui/API/inbounds/{idi}/delClient/{_id}', data=body)
-        return r
+    session = get_session(url, username, password)
+    r = session.post(f'/xui/API/inbounds/{idi}/delClient/{_id}')
+    return r
 
 
 def reset_inbound_traffic(url, username, password, idi) -> httpx.Response:
@@ -166,14 +341,28 @@ def reset_inbound_traffic(url, username, password, idi) -> httpx.Response:
     Returns:
         httpx.Response: HTTP response object indicating the success or failure of the reset.
     """
-    with httpx.Client() as client:
-        body = {
-            "username": username,
-            "password": password
-        }
-        client.post(url + '/login', data=body)
-        r = client.post(url + f'/xui/API/inbounds/resetAllClientTraffics/{idi}')
-        return r
+    session = get_session(url, username, password)
+    r = session.post(f'/xui/API/inbounds/resetAllClientTraffics/{idi}')
+    return r
+
+
+def reset_client_traffic(url, username, password, idi, email) -> httpx.Response:
+    """
+    Reset the traffic of a single client of an inbound using authentication.
+
+    Args:
+        url (str): URL to the service.
+        username (str): Username for authentication.
+        password (str): Password for authentication.
+        idi: Identifier for the inbound.
+        email (str): Email of the client.
+
+    Returns:
+        httpx.Response: HTTP response object indicating the success or failure of the reset.
+    """
+    session = get_session(url, username, password)
+    r = session.post(f'/xui/API/inbounds/{idi}/resetClientTraffic/{email}')
+    return r
 
 
 def edit_client(url, username, password, idi, _id, user) -> httpx.Response:
@@ -191,20 +380,15 @@ def edit_client(url, username, password, idi, _id, user) -> httpx.Response:
     Returns:
         httpx.Response: HTTP response object indicating the success or failure of the edit operation.
     """
-    with httpx.Client() as client:
-        body = {
-            "username": username,
-            "password": password
-        }
-        client.post(url + '/login', data=body)
-        body = {
-            "id": idi,
-            "settings": json.dumps({
-                "clients": [user]
-            })
-        }
-        r = client.post(url + f'/xui/API/inbounds/updateClient/{_id}', data=body)
-        return r
+    session = get_session(url, username, password)
+    body = {
+        "id": idi,
+        "settings": json.dumps({
+            "clients": [user]
+        })
+    }
+    r = session.post(f'/xui/API/inbounds/updateClient/{_id}', data=body)
+    return r
 
 
 def get_client(url, username, password, email) -> httpx.Response:
@@ -220,11 +404,7 @@ def get_client(url, username, password, email) -> httpx.Response:
     Returns:
         httpx.Response: HTTP response object containing client information.
     """
-    with httpx.Client() as client:
-        body = {
-            "username": username,
-            "password": password
-        }
-        client.post(url + '/login', data=body)
-        r = client.get(url + f'/xui/API/inbounds/getClientTraffics/{email}')
-        return r
+    session = get_session(url, username, password)
+    r = single_flight.do(('get_client', url, username, password, email), session.get,
+                         f'/xui/API/inbounds/getClientTraffics/{email}')
+    return r
@@ -0,0 +1,301 @@
+import asyncio
+import json
+import time
+import weakref
+from typing import Dict, Tuple
+
+import httpx
+
+from utilities.api_call import is_auth_failure, login_succeeded
+from utilities.panel_health import get_health
+from utilities.single_flight import SingleFlight
+
+# Kept apart from utilities.api_call.single_flight so a blocking caller never waits on a coroutine
+# that needs its own thread's event loop to finish.
+single_flight = SingleFlight()
+
+
+class AsyncPanelSession:
+    """
+    Asyncio counterpart of utilities.api_call.PanelSession.
+
+    The session cookie and connection pool are reused across calls, and the panel is only asked
+    to log in again when it answers with an auth failure or a redirect. An httpx.AsyncClient is
+    bound to the event loop it is used on, so sessions are kept per loop.
+
+    Args:
+        url (str): URL to the service.
+        username (str): Username for authentication.
+        password (str): Password for authentication.
+    """
+
+    def __init__(self, url: str, username: str, password: str):
+        self.url = url
+        self.username = username
+        self.password = password
+        self._client = httpx.AsyncClient(base_url=url, transport=transports.get(url))
+        self._lock = asyncio.Lock()
+        self._logged_in = False
+
+    async def login(self) -> httpx.Response:
+        """
+        Log in to the panel and store the session cookie on the client.
+
+        Returns:
+            httpx.Response: HTTP response object of the login request.
+        """
+        async with self._lock:
+            body = {
+                "username": self.username,
+                "password": self.password
+            }
+            r = await self._client.post('/login', data=body)
+            self._logged_in = login_succeeded(r)
+            return r
+
+    async def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """
+        Send a request to the panel, logging in first or again when needed.
+
+        The outcome is recorded in the panel's health, and the request fails fast with
+        PanelUnavailable while the panel's circuit breaker is open.
+
+        Args:
+            method (str): HTTP method.
+            path (str): Path relative to the panel URL.
+            **kwargs: Extra arguments passed to httpx.
+
+        Returns:
+            httpx.Response: HTTP response object of the request.
+        """
+        health = get_health(self.url)
+        health.before_request()
+        start = time.monotonic()
+        try:
+            if not self._logged_in:
+                await self.login()
+            r = await self._client.request(method, path, **kwargs)
+            if is_auth_failure(r):
+                await self.login()
+                r = await self._client.request(method, path, **kwargs)
+        except httpx.HTTPError:
+            health.record(False, time.monotonic() - start)
+            raise
+        except BaseException:
+            health.abandon()
+            raise
+        health.record(r.status_code < 500, time.monotonic() - start)
+        return r
+
+    async def get(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request('POST', path, **kwargs)
+
+    async def close(self):
+        """
+        Close the underlying connection pool.
+        """
+        await self._client.aclose()
+        self._logged_in = False
+
+
+_sessions: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, str, str], AsyncPanelSession]]' = \
+    weakref.WeakKeyDictionary()
+# Transports used instead of the network for specific panel URLs, e.g. utilities.fake_panel.
+transports: Dict[str, httpx.AsyncBaseTransport] = {}
+
+
+def forget_sessions(url: str):
+    """
+    Forget the sessions of a panel URL on every event loop, so the next call opens a new one.
+
+    Args:
+        url (str): URL to the service.
+    """
+    for sessions in list(_sessions.values()):
+        for key in [key for key in sessions if key[0] == url]:
+            del sessions[key]
+
+
+def get_session(url: str, username: str, password: str) -> AsyncPanelSession:
+    """
+    Get the shared session for a panel on the running event loop, creating it on first use.
+
+    Args:
+        url (str): URL to the service.
+        username (str): Username for authentication.
+        password (str): Password for authentication.
+
+    Returns:
+        AsyncPanelSession: The session for the panel.
+    """
+    sessions = _sessions.setdefault(asyncio.get_running_loop(), {})
+    key = (url, username, password)
+    session = sessions.get(key)
+    if session is None:
+        session = sessions[key] = AsyncPanelSession(url, username, password)
+    return session
+
+
+async def get_inbounds(url, username, password) -> httpx.Response:
+    """
+    Get inbounds from a specified URL using authentication.
+
+    Args:
+        url (str): URL to the service.
+        username (str): Username for authentication.
+        password (str): Password for authentication.
+
+    Returns:
+        httpx.Response: HTTP response object containing the inbounds data.
+    """
+    session = get_session(url, username, password)
+    r = await single_flight.do_async(('get_inbounds', url, username, password), session.get, '/xui/API/inbounds/')
+    return r
+
+
+async def update_inbound(url, username, password, idi, data) -> httpx.Response:
+    """
+    Update an inbound using authentication.
+
+    Args:
+        url (str): URL to the service.
+        username (str): Username for authentication.
+        password (str): Password for authentication.
+        idi: Identifier for the inbound.
+        data (dict): Data to update the inbound.
+
+    Returns:
+        httpx.Response: HTTP response object indicating the success or failure of the update.
+    """
+    session = get_session(url, username, password)
+    r = await session.post(f'/xui/API/inbounds/update/{idi}', json=data)
+    return r
+
+
+async def get_inbound(url: str, username: str, password: str, idi: int) -> httpx.Response:
+    """
+    Get a specific inbound by ID using authentication.
+
+    Args:
+        url (str): URL to the service.
+        username (str): Username for authentication.
+        password (str): Password for authentication.
+        idi (int): Identifier for the inbound.
+
+    Returns:
+        httpx.Response: HTTP response object containing the specific inbound data.
+    """
+    session = get_session(url, username, password)
+    r = await single_flight.do_async(('get_inbound', url, username, password, idi), session.get,
+                                     f'/xui/API/inbounds/get/{idi}')
+    return r
+
+
+async def add_clients(url, username, password, idi, users) -> httpx.Response:
+    """
+    Add clients to an inbound using authentication.
+
+    Args:
+        url (str): URL to the service.
+        username (str): Username for authentication.
+        password (str): Password for authentication.
+        idi: Identifier for the inbound.
+        users (list): List of users to add to the inbound.
+
+    Returns:
+        httpx.Response: HTTP response object indicating the success or failure of the operation.
+    """
+    session = get_session(url, username, password)
+    body = {
+        "id": idi,
+        "settings": json.dumps({
+            "clients": users
+        })
+    }
+    r = await session.post('/xui/API/inbounds/addClient', data=body)
+    return r
+
+
+async def remove_client(url, username, password, idi, _id) -> httpx.Response:
+    """
+    Remove a client from an inbound using authentication.
+
+    Args:
+        url (str): URL to the service.
+        username (str): Username for authentication.
+        password (str): Password for authentication.
+        idi: Identifier for the inbound.
+        _id: Identifier for the client to remove.
+
+    Returns:
+        httpx.Response: HTTP response object indicating the success or failure of the removal.
+    """
+    session = get_session(url, username, password)
+    r = await session.post(f'/xui/API/inbounds/{idi}/delClient/{_id}')
+    return r
+
+
+async def reset_inbound_traffic(url, username, password, idi) -> httpx.Response:
+    """
+    Reset the traffic for an inbound using authentication.
+
+    Args:
+        url (str): URL to the service.
+        username (str): Username for authentication.
+        password (str): Password for authentication.
+        idi: Identifier for the inbound.
+
+    Returns:
+        httpx.Response: HTTP response object indicating the success or failure of the reset.
+    """
+    session = get_session(url, username, password)
+    r = await session.post(f'/xui/API/inbounds/resetAllClientTraffics/{idi}')
+    return r
+
+
+async def edit_client(url, username, password, idi, _id, user) -> httpx.Response:
+    """
+    Edit a client in an inbound using authentication.
+
+    Args:
+        url (str): URL to the service.
+        username (str): Username for authentication.
+        password (str): Password for authentication.
+        idi: Identifier for the inbound.
+        _id: Identifier for the client to edit.
+        user (dict): User data for editing.
+
+    Returns:
+        httpx.Response: HTTP response object indicating the success or failure of the edit operation.
+    """
+    session = get_session(url, username, password)
+    body = {
+        "id": idi,
+        "settings": json.dumps({
+            "clients": [user]
+        })
+    }
+    r = await session.post(f'/xui/API/inbounds/updateClient/{_id}', data=body)
+    return r
+
+
+async def get_client(url, username, password, email) -> httpx.Response:
+    """
+    Get client information by email using authentication.
+
+    Args:
+        url (str): URL to the service.
+        username (str): Username for authentication.
+        password (str): Password for authentication.
+        email (str): Email of the client to retrieve information for.
+
+    Returns:
+        httpx.Response: HTTP response object containing client information.
+    """
+    session = get_session(url, username, password)
+    r = await single_flight.do_async(('get_client', url, username, password, email), session.get,
+                                     f'/xui/API/inbounds/getClientTraffics/{email}')
+    return r
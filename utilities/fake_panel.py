@@ -0,0 +1,302 @@
+"""
+fake_panel.py
+---------
+In-process stand-in for a 3x-ui panel, for exercising utilities.api_call, models.server.Server
+and the minute tasks without a real panel.
+
+    panel = FakePanel(clients=2000, latency=0.05, traffic_growth=1024 ** 2)
+    panel.install()
+    server = Server.model_validate(panel.server_document())
+    server.get_clients()
+    print(panel.requests)
+
+The panel is served through httpx.MockTransport and implements the /login and
+/xui/API/inbounds/... endpoints the code uses.
+"""
+import asyncio
+import json
+import random
+import secrets
+import time
+import uuid
+from collections import Counter
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+import httpx
+
+from utilities import api_call, async_api_call
+
+
+class FakePanel:
+    """
+    A fake x-ui panel with a single inbound.
+
+    Args:
+        ip_address (str): IP address the panel pretends to listen on.
+        port (int): Panel port.
+        username (str): Panel username.
+        password (str): Panel password.
+        inbound_id (int): ID of the inbound.
+        protocol (str): Protocol of the inbound, vless or vmess.
+        clients (int): Number of clients to create up front.
+        latency (float): Seconds every request takes.
+        error_rate (float): Share of requests answered with a 500 error.
+        traffic_growth (int): Maximum bytes each client's up and down counters grow by every time
+            traffic is read.
+        seed (int, optional): Seed for the random generator, for reproducible runs.
+    """
+
+    def __init__(self, ip_address='127.0.0.1', port=54321, username='admin', password='admin', inbound_id=1,
+                 protocol='vless', clients=0, latency=0.0, error_rate=0.0, traffic_growth=0,
+                 seed: Optional[int] = None):
+        self.ip_address = ip_address
+        self.port = port
+        self.username = username
+        self.password = password
+        self.inbound_id = inbound_id
+        self.protocol = protocol
+        self.latency = latency
+        self.error_rate = error_rate
+        self.traffic_growth = traffic_growth
+        self.down = False  # When True every request fails with a connection error
+        self.random = random.Random(seed)
+        self.requests = Counter()  # Number of requests per endpoint
+        self.tokens = set()
+        self.clients = {}  # id -> client settings
+        self.stats = {}  # email -> client traffic
+        self.populate(clients)
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.ip_address}:{self.port}'
+
+    def server_document(self, name='Fake') -> dict:
+        """
+        A servers collection document pointing at this panel.
+
+        Args:
+            name (str): Name of the server.
+
+        Returns:
+            dict: Data accepted by Server.model_validate.
+        """
+        return {
+            'name': name,
+            'inbound_id': self.inbound_id,
+            'ip_address': self.ip_address,
+            'panel_port': self.port,
+            'panel_username': self.username,
+            'panel_password': self.password,
+            'connect_domain': self.ip_address,
+        }
+
+    def install(self):
+        """
+        Route the sync and async panel clients to this panel instead of the network.
+        """
+        api_call.transports[self.url] = httpx.MockTransport(self.handle)
+        async_api_call.transports[self.url] = httpx.MockTransport(self.handle_async)
+        api_call.close_sessions(self.url)
+        async_api_call.forget_sessions(self.url)
+
+    def uninstall(self):
+        """
+        Route the panel clients back to the network.
+        """
+        api_call.transports.pop(self.url, None)
+        async_api_call.transports.pop(self.url, None)
+        api_call.close_sessions(self.url)
+        async_api_call.forget_sessions(self.url)
+
+    def populate(self, count: int, total_gb: float = 50):
+        """
+        Create clients with random emails.
+
+        Args:
+            count (int): Number of clients to create.
+            total_gb (float): Traffic limit of each client.
+        """
+        for _ in range(count):
+            client = api_call.generate_client(total_gb, 30 * 24 * 3600, secrets.token_hex(5),
+                                              uuid.UUID(int=self.random.getrandbits(128)))
+            self._add_client(client)
+
+    def grow_traffic(self, emails=None):
+        """
+        Grow the clients' counters by up to `traffic_growth` bytes.
+
+        Args:
+            emails (list, optional): Emails of the clients to grow, every client by default.
+        """
+        if not self.traffic_growth:
+            return
+        for stat in (self.stats.values() if emails is None else [self.stats[x] for x in emails if x in self.stats]):
+            stat['up'] += self.random.randint(0, self.traffic_growth)
+            stat['down'] += self.random.randint(0, self.traffic_growth)
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        request.read()
+        if self.latency:
+            time.sleep(self.latency)
+        return self.respond(request)
+
+    async def handle_async(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.respond(request)
+
+    def respond(self, request: httpx.Request) -> httpx.Response:
+        """
+        Answer a request the way a 3x-ui panel would.
+
+        Args:
+            request (httpx.Request): The request sent by the client.
+
+        Returns:
+            httpx.Response: The panel's response.
+        """
+        if self.down:
+            raise httpx.ConnectError('Fake panel is down', request=request)
+
+        path = request.url.path.rstrip('/')
+        parts = path.split('/')
+        endpoint = '/'.join(parts[:5]) if path.startswith('/xui/API/inbounds') else path
+        self.requests[endpoint] += 1
+
+        if self.error_rate and self.random.random() < self.error_rate:
+            return httpx.Response(500, text='Injected error')
+
+        if path == '/login':
+            return self._login(request)
+        if self._session_token(request) not in self.tokens:
+            return httpx.Response(307, headers={'Location': '/'})
+
+        if path == '/xui/API/inbounds' and request.method == 'GET':
+            self.grow_traffic()
+            return self._ok([self._inbound(client_stats=True)])
+        if path == f'/xui/API/inbounds/get/{self.inbound_id}':
+            return self._ok(self._inbound(client_stats=False))
+        if path.startswith('/xui/API/inbounds/get/'):
+            return self._error('Inbound Not Found')
+        if path.startswith('/xui/API/inbounds/getClientTraffics/'):
+            self.grow_traffic([parts[-1]])
+            return self._ok(self.stats.get(parts[-1]))
+        if path == '/xui/API/inbounds/addClient':
+            return self._add_clients(self._settings(request))
+        if path.startswith('/xui/API/inbounds/updateClient/'):
+            return self._update_client(parts[-1], self._settings(request))
+        if path == f'/xui/API/inbounds/{self.inbound_id}/delClient/{parts[-1]}':
+            return self._delete_client(parts[-1])
+        if path.startswith(f'/xui/API/inbounds/{self.inbound_id}/resetClientTraffic/'):
+            if parts[-1] in self.stats:
+                self.stats[parts[-1]]['up'] = self.stats[parts[-1]]['down'] = 0
+            return self._ok(None, 'Traffic has been reset')
+        if path == f'/xui/API/inbounds/resetAllClientTraffics/{self.inbound_id}':
+            for stat in self.stats.values():
+                stat['up'] = stat['down'] = 0
+            return self._ok(None)
+        if path == f'/xui/API/inbounds/update/{self.inbound_id}':
+            return self._update_inbound(json.loads(request.content))
+        return httpx.Response(404)
+
+    def _login(self, request: httpx.Request) -> httpx.Response:
+        form = parse_qs(request.content.decode())
+        if form.get('username') != [self.username] or form.get('password') != [self.password]:
+            return self._error('Wrong username or password')
+        token = secrets.token_hex(16)
+        self.tokens.add(token)
+        host = urlsplit(self.url).hostname
+        return httpx.Response(200, json={'success': True, 'msg': 'Login Successfully', 'obj': None},
+                              headers={'Set-Cookie': f'session={token}; Path=/; Domain={host}'})
+
+    @staticmethod
+    def _session_token(request: httpx.Request) -> Optional[str]:
+        for cookie in request.headers.get('Cookie', '').split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == 'session':
+                return value
+        return None
+
+    def _inbound(self, client_stats: bool) -> dict:
+        # Like 3x-ui, only the inbound list preloads clientStats; the single inbound has null
+        return {
+            'id': self.inbound_id,
+            'up': sum(stat['up'] for stat in self.stats.values()),
+            'down': sum(stat['down'] for stat in self.stats.values()),
+            'total': 0,
+            'remark': 'fake',
+            'enable': True,
+            'expiryTime': 0,
+            'clientStats': [dict(stat) for stat in self.stats.values()] if client_stats else None,
+            'listen': '',
+            'port': 443,
+            'protocol': self.protocol,
+            'settings': json.dumps({'clients': list(self.clients.values()), 'decryption': 'none'}),
+            'streamSettings': json.dumps({'network': 'ws', 'security': 'none',
+                                          'wsSettings': {'path': '/', 'headers': {}}}),
+            'tag': f'inbound-{self.port}',
+            'sniffing': json.dumps({'enabled': True, 'destOverride': ['http', 'tls']}),
+        }
+
+    @staticmethod
+    def _settings(request: httpx.Request) -> dict:
+        form = parse_qs(request.content.decode())
+        return json.loads(form['settings'][0])
+
+    def _add_client(self, client: dict):
+        self.clients[client['id']] = client
+        self.stats[client['email']] = {
+            'id': len(self.stats) + 1,
+            'inboundId': self.inbound_id,
+            'enable': True,
+            'email': client['email'],
+            'up': 0,
+            'down': 0,
+            'expiryTime': client.get('expiryTime', 0),
+            'total': client.get('totalGB', 0),
+        }
+
+    def _add_clients(self, settings: dict) -> httpx.Response:
+        emails = {client['email'] for client in self.clients.values()}
+        for client in settings['clients']:
+            if client['email'] in emails or client['id'] in self.clients:
+                return self._error(f"Duplicate email: {client['email']}")
+        for client in settings['clients']:
+            self._add_client(client)
+        return self._ok(None, 'Client(s) added Successfully')
+
+    def _update_client(self, client_id: str, settings: dict) -> httpx.Response:
+        if client_id not in self.clients:
+            return self._error(f'Client Not Found In Inbound For ID: {client_id}')
+        old = self.clients.pop(client_id)
+        client = settings['clients'][0]
+        self.clients[client['id']] = client
+        stat = self.stats.pop(old['email'])
+        stat.update(email=client['email'], expiryTime=client.get('expiryTime', 0), total=client.get('totalGB', 0))
+        self.stats[client['email']] = stat
+        return self._ok(None, 'Client updated Successfully')
+
+    def _delete_client(self, client_id: str) -> httpx.Response:
+        if client_id not in self.clients:
+            return self._error(f'Client Not Found In Inbound For ID: {client_id}')
+        if len(self.clients) == 1:
+            return self._error('no client remained in Inbound')
+        client = self.clients.pop(client_id)
+        self.stats.pop(client['email'], None)
+        return self._ok(None, 'Client deleted Successfully')
+
+    def _update_inbound(self, data: dict) -> httpx.Response:
+        self.clients = {client['id']: client for client in json.loads(data['settings'])['clients']}
+        emails = {client['email'] for client in self.clients.values()}
+        self.stats = {email: stat for email, stat in self.stats.items() if email in emails}
+        return self._ok(None, 'Inbound updated Successfully')
+
+    @staticmethod
+    def _ok(obj, msg='') -> httpx.Response:
+        return httpx.Response(200, json={'success': True, 'msg': msg, 'obj': obj})
+
+    @staticmethod
+    def _error(msg: str) -> httpx.Response:
+        return httpx.Response(200, json={'success': False, 'msg': msg, 'obj': None})
@@ -0,0 +1,74 @@
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from bson import ObjectId
+
+from configuration import Config
+
+config = Config()
+
+# Fields of an inbound that utilities.share needs to build a link.
+LINK_FIELDS = ('protocol', 'port', 'streamSettings', 'sniffing')
+
+_cache: Dict[Tuple[ObjectId, str, int], Tuple[float, dict]] = {}
+_lock = threading.Lock()
+
+
+def link_settings(inbound: dict) -> dict:
+    """
+    Strip an inbound down to the fields needed for link generation.
+
+    Args:
+        inbound (dict): The inbound object returned by the panel.
+
+    Returns:
+        dict: The protocol, port, streamSettings and sniffing of the inbound.
+    """
+    return {key: inbound[key] for key in LINK_FIELDS if key in inbound}
+
+
+def get(key: Tuple[ObjectId, str, int]) -> Optional[dict]:
+    """
+    Get the cached link settings of an inbound if they have not expired.
+
+    Args:
+        key (tuple): Server ID, panel URL and inbound ID.
+
+    Returns:
+        Optional[dict]: The cached link settings, or None on a miss.
+    """
+    with _lock:
+        entry = _cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+
+def put(key: Tuple[ObjectId, str, int], inbound: dict) -> dict:
+    """
+    Cache the link settings of an inbound for `inbound-cache-ttl` seconds.
+
+    Args:
+        key (tuple): Server ID, panel URL and inbound ID.
+        inbound (dict): The inbound object returned by the panel.
+
+    Returns:
+        dict: The cached link settings.
+    """
+    settings = link_settings(inbound)
+    with _lock:
+        _cache[key] = (time.monotonic() + config.inbound_cache_ttl, settings)
+    return settings
+
+
+def invalidate(server_id: ObjectId):
+    """
+    Drop every cached inbound of a server, e.g. after it was edited.
+
+    Args:
+        server_id (ObjectId): The MongoDB ID of the server.
+    """
+    with _lock:
+        for key in [key for key in _cache if key[0] == server_id]:
+            del _cache[key]
@@ -0,0 +1,165 @@
+"""
+indexes.py
+---------
+Registry of the MongoDB indexes behind the project's hot queries. ensure_indexes() applies it at
+startup and is a no-op for indexes that already exist; check_indexes() reports what is missing,
+unused or removable. Run `python -m utilities.indexes [--ensure]` for a report.
+"""
+import logging
+import sys
+from typing import Dict, List
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure, PyMongoError
+
+from configuration import Config
+from utilities import subscription_layout
+
+config = Config()
+
+# Claims filter and sort on available_at (see utilities.job_queue), enqueue-time coalescing
+# matches unclaimed jobs of a client (see minute_tasks.add_client.add_job).
+_QUEUE = [IndexModel([('available_at', ASCENDING)], name='available_at')]
+_PROVISIONING_QUEUE = _QUEUE + [
+    IndexModel([('server', ASCENDING), ('uuid', ASCENDING), ('owner', ASCENDING)], name='server_uuid_owner')
+]
+
+# Lookups by client email on a server, dict layout: servers.<server id>. Under the array layout
+# it would also index servers.usage, adding a second index write to every usage update, so it is
+# only declared until no document is left in the dict layout (see declared_indexes).
+_SERVERS_WILDCARD = IndexModel([('servers.$**', ASCENDING)], name='servers_wildcard')
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    'subscriptions': [
+        # usage_expiry_scanner
+        IndexModel([('active', ASCENDING), ('expiry_time', ASCENDING)], name='active_expiry_time'),
+        IndexModel([('active', ASCENDING), ('remaining', ASCENDING)], name='active_remaining'),
+        # User.subscriptions, subscription counts per user
+        IndexModel([('user_id', ASCENDING), ('active', DESCENDING)], name='user_id_active'),
+        # Lookups by client email on a server, array layout (see utilities.subscription_layout)
+        IndexModel([('servers.server', ASCENDING), ('servers.email', ASCENDING)], name='servers_server_email'),
+    ],
+    'users': [
+        # User.referral_amount, Referral.amount, Referral.users
+        IndexModel([('referrer.id', ASCENDING)], name='referrer_id'),
+    ],
+    'invoices': [
+        # invoice_check
+        IndexModel([('is_final', ASCENDING)], name='is_final'),
+    ],
+    'products': [
+        IndexModel([('status', ASCENDING), ('stock', ASCENDING)], name='status_stock'),
+    ],
+    'currencies': [
+        IndexModel([('name', ASCENDING)], name='name'),
+    ],
+    'prices': [
+        IndexModel([('name', ASCENDING)], name='name'),
+    ],
+    'usage_counters': [
+        IndexModel([('server', ASCENDING), ('email', ASCENDING)], name='server_email', unique=True),
+    ],
+    'workers': [
+        IndexModel([('group', ASCENDING), ('expires_at', ASCENDING)], name='group_expires_at'),
+    ],
+    'add_queue': _PROVISIONING_QUEUE,
+    'delete_queue': _PROVISIONING_QUEUE,
+    'notifications_queue': _QUEUE,
+    'invoice_queue': _QUEUE,
+}
+
+
+def removable_indexes() -> Dict[str, List[str]]:
+    """
+    Indexes of a previous configuration that no query needs anymore, per collection.
+
+    servers_wildcard still serves the documents left in the dict layout until the migration to
+    the array layout is done.
+    """
+    if config.subscription_servers_layout == 'array' and subscription_layout.migration_done():
+        return {'subscriptions': [_SERVERS_WILDCARD.document['name']]}
+    return {}
+
+
+def declared_indexes() -> Dict[str, List[IndexModel]]:
+    """
+    The registry, with servers_wildcard unless it is removable.
+    """
+    if removable_indexes():
+        return INDEXES
+    return {**INDEXES, 'subscriptions': INDEXES['subscriptions'] + [_SERVERS_WILDCARD]}
+
+
+def ensure_indexes(db=None) -> List[str]:
+    """
+    Create the indexes of the registry that don't exist yet.
+
+    An index that can't be created (e.g. a unique index over duplicate documents, or one with
+    the same name and different options) is logged and skipped, so startup never fails on it.
+
+    Args:
+        db: The database, the configured one by default.
+
+    Returns:
+        List[str]: `collection.index` names of the indexes that couldn't be created.
+    """
+    db = db if db is not None else config.get_db()
+    failed = []
+    for collection, indexes in declared_indexes().items():
+        for index in indexes:
+            name = index.document['name']
+            try:
+                db[collection].create_indexes([index])
+            except PyMongoError as e:
+                logging.error(f"Failed to create index {collection}.{name}: {e}")
+                failed.append(f'{collection}.{name}')
+    return failed
+
+
+def check_indexes(db=None) -> Dict[str, Dict[str, List[str]]]:
+    """
+    Compare the indexes in the database with the registry.
+
+    Args:
+        db: The database, the configured one by default.
+
+    Returns:
+        Dict[str, Dict[str, List[str]]]: Per collection with findings, the `missing` registry
+            indexes, the `undeclared` indexes not in the registry, and the `unused` indexes that
+            served no operation since the server started, and the `removable` indexes that can be
+            dropped (see removable_indexes).
+    """
+    db = db if db is not None else config.get_db()
+    registry, removable = declared_indexes(), removable_indexes()
+    report = {}
+    for collection in sorted(set(registry) | set(db.list_collection_names())):
+        existing = set(db[collection].index_information()) - {'_id_'}
+        declared = {index.document['name'] for index in registry.get(collection, [])}
+        try:
+            unused = sorted(stats['name'] for stats in db[collection].aggregate([{'$indexStats': {}}])
+                            if stats['name'] != '_id_' and not stats['accesses']['ops'])
+        except OperationFailure:
+            unused = []  # $indexStats needs the indexStats privilege
+        droppable = existing & set(removable.get(collection, []))
+        findings = {'missing': sorted(declared - existing), 'undeclared': sorted(existing - declared - droppable),
+                    'unused': unused, 'removable': sorted(droppable)}
+        if any(findings.values()):
+            report[collection] = findings
+    return report
+
+
+def log_index_report(db=None):
+    for collection, findings in check_indexes(db).items():
+        for kind, names in findings.items():
+            if names:
+                logging.warning(f"Indexes {kind} on {collection}: {', '.join(names)}")
+
+
+if __name__ == '__main__':
+    if '--ensure' in sys.argv:
+        ensure_indexes()
+    for collection, findings in check_indexes().items():
+        print(collection)
+        for kind, names in findings.items():
+            if names:
+                print(f'  {kind}: {", ".join(names)}')
@@ -0,0 +1,187 @@
+import datetime
+import random
+from typing import List, Optional
+
+from pymongo import ReturnDocument
+
+from configuration import Config
+from utilities.leader import REPLICA_ID
+
+config = Config()
+
+# Identifies this process as the owner of the jobs it claims. hostname:pid alone can repeat across
+# replicas (shared hostname with host networking, PID 1 in every container), hence the random suffix.
+WORKER_ID = REPLICA_ID
+
+
+class BaseJobQueue:
+    """
+    Lease-based job queue on a MongoDB collection.
+
+    A worker claims a job by atomically setting a lease on it, so no two workers process the same
+    job. A job whose lease runs out (the worker crashed) becomes visible again. A job that failed
+    is scheduled again with exponential backoff and jitter, and moved to the `<name>_dead`
+    collection after `queue-max-attempts` claims.
+
+    Job documents keep their payload at the top level next to the queue fields `attempts`,
+    `available_at`, `lease_until`, `owner` and `created_at`. Jobs inserted without these fields
+    are claimable right away.
+
+    Args:
+        collection: The queue collection.
+        lease_seconds (float): How long a claimed job stays invisible to other workers.
+        max_attempts (int): Claims before a failing job is dead-lettered.
+    """
+
+    def __init__(self, collection, lease_seconds: Optional[float] = None, max_attempts: Optional[int] = None):
+        self.collection = collection
+        self.dead_letters = collection.database[f'{collection.name}_dead']
+        self.lease_seconds = lease_seconds or config.queue_lease_seconds
+        self.max_attempts = max_attempts or config.queue_max_attempts
+
+    @staticmethod
+    def now() -> datetime.datetime:
+        return datetime.datetime.now()
+
+    def new_job(self, job: dict) -> dict:
+        now = self.now()
+        return {**job, 'attempts': 0, 'created_at': now, 'available_at': now, 'lease_until': None, 'owner': None}
+
+    def claim_query(self, query: Optional[dict]) -> dict:
+        now = self.now()
+        return {**(query or {}), 'available_at': {'$not': {'$gt': now}}, 'lease_until': {'$not': {'$gt': now}}}
+
+    def claim_update(self) -> dict:
+        return {
+            '$set': {'lease_until': self.now() + datetime.timedelta(seconds=self.lease_seconds), 'owner': WORKER_ID},
+            '$inc': {'attempts': 1}
+        }
+
+    @staticmethod
+    def backoff(attempts: int) -> datetime.timedelta:
+        delay = min(config.queue_retry_max_delay, config.queue_retry_base_delay * 2 ** max(0, attempts - 1))
+        return datetime.timedelta(seconds=random.uniform(delay / 2, delay))
+
+    def retry_update(self, job: dict, error: str) -> dict:
+        return {'$set': {'available_at': self.now() + self.backoff(job.get('attempts', 1)), 'lease_until': None,
+                         'owner': None, 'last_error': error}}
+
+    def dead_letter_document(self, job: dict, error: str) -> dict:
+        return {**job, 'error': error, 'failed_at': self.now()}
+
+    def exhausted(self, job: dict) -> bool:
+        return job.get('attempts', 0) >= self.max_attempts
+
+
+class JobQueue(BaseJobQueue):
+    """
+    Lease-based job queue on a pymongo collection. See BaseJobQueue.
+    """
+
+    def put(self, job: dict):
+        """
+        Enqueue a job.
+
+        Args:
+            job (dict): The job's payload.
+
+        Returns:
+            ObjectId: The ID of the job.
+        """
+        return self.collection.insert_one(self.new_job(job)).inserted_id
+
+    def claim(self, query: Optional[dict] = None) -> Optional[dict]:
+        """
+        Atomically claim the next available job.
+
+        Args:
+            query (dict, optional): Extra conditions the job has to match.
+
+        Returns:
+            Optional[dict]: The claimed job, or None if no job is available.
+        """
+        return self.collection.find_one_and_update(self.claim_query(query), self.claim_update(),
+                                                   sort=[('available_at', 1)], return_document=ReturnDocument.AFTER)
+
+    def claim_many(self, limit: int, query: Optional[dict] = None) -> List[dict]:
+        """
+        Claim up to `limit` available jobs.
+        """
+        jobs = []
+        while len(jobs) < limit:
+            job = self.claim(query)
+            if job is None:
+                break
+            jobs.append(job)
+        return jobs
+
+    def ack(self, job_ids: list):
+        """
+        Remove finished jobs from the queue.
+
+        Args:
+            job_ids (list): IDs of the jobs claimed by this worker.
+        """
+        if job_ids:
+            self.collection.delete_many({'_id': {'$in': list(job_ids)}, 'owner': WORKER_ID})
+
+    def release(self, job: dict, error: str):
+        """
+        Give a failed job back to the queue with backoff, or dead-letter it once its attempts are used up.
+
+        Args:
+            job (dict): The claimed job.
+            error (str): Why the job failed.
+        """
+        if self.exhausted(job):
+            self.dead_letter(job, error)
+        else:
+            self.collection.update_one({'_id': job['_id'], 'owner': WORKER_ID}, self.retry_update(job, error))
+
+    def dead_letter(self, job: dict, error: str):
+        """
+        Move a job to the dead-letter collection.
+
+        Args:
+            job (dict): The job.
+            error (str): Why the job failed.
+        """
+        self.dead_letters.replace_one({'_id': job['_id']}, self.dead_letter_document(job, error), upsert=True)
+        self.collection.delete_one({'_id': job['_id']})
+
+
+class AsyncJobQueue(BaseJobQueue):
+    """
+    Lease-based job queue on a motor collection. See BaseJobQueue.
+    """
+
+    async def put(self, job: dict):
+        return (await self.collection.insert_one(self.new_job(job))).inserted_id
+
+    async def claim(self, query: Optional[dict] = None) -> Optional[dict]:
+        return await self.collection.find_one_and_update(self.claim_query(query), self.claim_update(),
+                                                         sort=[('available_at', 1)],
+                                                         return_document=ReturnDocument.AFTER)
+
+    async def claim_many(self, limit: int, query: Optional[dict] = None) -> List[dict]:
+        jobs = []
+        while len(jobs) < limit:
+            job = await self.claim(query)
+            if job is None:
+                break
+            jobs.append(job)
+        return jobs
+
+    async def ack(self, job_ids: list):
+        if job_ids:
+            await self.collection.delete_many({'_id': {'$in': list(job_ids)}, 'owner': WORKER_ID})
+
+    async def release(self, job: dict, error: str):
+        if self.exhausted(job):
+            await self.dead_letter(job, error)
+        else:
+            await self.collection.update_one({'_id': job['_id'], 'owner': WORKER_ID}, self.retry_update(job, error))
+
+    async def dead_letter(self, job: dict, error: str):
+        await self.dead_letters.replace_one({'_id': job['_id']}, self.dead_letter_document(job, error), upsert=True)
+        await self.collection.delete_one({'_id': job['_id']})
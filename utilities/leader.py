@@ -0,0 +1,72 @@
+import os
+import socket
+import time
+import uuid
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from configuration import Config
+
+config = Config()
+leases_db = config.get_db().leases
+
+# Identifies this replica as the holder of the leases it acquires.
+REPLICA_ID = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+class LeaderLease:
+    """
+    MongoDB lease making exactly one replica the leader for a name (e.g. a periodic job).
+
+    The lease is a document in the `leases` collection whose `expires_at` is pushed forward by the
+    holder on every heartbeat. When the holder dies and stops renewing, any other replica acquires
+    the lease once it expires. Expiry is computed with the database clock ($$NOW), so clock skew
+    between replicas doesn't matter.
+
+    Args:
+        name (str): Name of the lease.
+        ttl (float, optional): Seconds the lease stays valid after a heartbeat.
+    """
+
+    def __init__(self, name: str, ttl: float = None):
+        self.name = name
+        self.ttl = ttl or config.leader_lease_seconds
+        self.valid_until = 0.0  # Local monotonic deadline of the last successful heartbeat
+
+    @property
+    def is_leader(self) -> bool:
+        return self.valid_until > time.monotonic()
+
+    def acquire(self) -> bool:
+        """
+        Acquire the lease, or renew it if this replica already holds it.
+
+        Returns:
+            bool: True if this replica holds the lease.
+        """
+        started = time.monotonic()
+        try:
+            leases_db.find_one_and_update(
+                {'_id': self.name, '$or': [{'owner': REPLICA_ID}, {'$expr': {'$lte': ['$expires_at', '$$NOW']}}]},
+                [{'$set': {
+                    'owner': REPLICA_ID,
+                    'heartbeat_at': '$$NOW',
+                    'expires_at': {'$add': ['$$NOW', int(self.ttl * 1000)]}
+                }}],
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Another replica holds a live lease
+            self.valid_until = 0.0
+            return False
+        self.valid_until = started + self.ttl
+        return True
+
+    def release(self):
+        """
+        Give the lease up so another replica can take over right away.
+        """
+        self.valid_until = 0.0
+        leases_db.delete_one({'_id': self.name, 'owner': REPLICA_ID})
@@ -68,12 +68,13 @@ def generate_list_markup(items: list, page: int, count: int, type_: str):
                 InlineKeyboardButton(f'{user.purchase_amount}', callback_data=f'control-users{{{user.id}}}')
             ])
     elif type_ == "servers":
-        headers = ["🔍 اسم", "🎯 آیپی", "🪪 آیدی اینباند"]
+        headers = ["🔍 اسم", "🎯 آیپی", "🪪 آیدی اینباند", "🩺 وضعیت"]
         for server in items:
             keyboard.append([
                 InlineKeyboardButton(f'{server.name}', callback_data=f'control-servers{{{server.mongo_id}}}'),
                 InlineKeyboardButton(f'{server.ip_address}', callback_data=f'control-servers{{{server.mongo_id}}}'),
-                InlineKeyboardButton(f'{server.inbound_id}', callback_data=f'control-servers{{{server.mongo_id}}}')
+                InlineKeyboardButton(f'{server.inbound_id}', callback_data=f'control-servers{{{server.mongo_id}}}'),
+                InlineKeyboardButton(f'{server.health.label}', callback_data=f'control-servers{{{server.mongo_id}}}')
             ])
     elif type_ == "products":
         headers = ["🔍 اسم", "🎲 مضرب هزینه", "⚖️ موجودی"]
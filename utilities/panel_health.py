@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import deque
+from typing import Dict
+
+from configuration import Config
+
+config = Config()
+
+
+class PanelUnavailable(Exception):
+    """
+    Raised instead of contacting a panel whose circuit breaker is open.
+    """
+
+
+class PanelHealth:
+    """
+    Rolling health of a single panel with a circuit breaker.
+
+    The breaker opens after `panel-failure-threshold` consecutive failures, or when the error rate
+    over the last `panel-health-window` requests reaches `panel-error-rate`. While open, requests
+    fail fast. After `panel-cooldown` seconds a single probe request is let through (half-open);
+    its success closes the breaker again and its failure reopens it.
+
+    Args:
+        url (str): URL of the panel.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, url: str):
+        self.url = url
+        self.state = self.CLOSED
+        self.samples = deque(maxlen=config.panel_health_window)  # (ok, latency) of recent requests
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def error_rate(self) -> float:
+        """
+        Share of failed requests in the rolling window.
+        """
+        if not self.samples:
+            return 0.0
+        return sum(1 for ok, _ in self.samples if not ok) / len(self.samples)
+
+    @property
+    def latency(self) -> float:
+        """
+        Average latency of the requests in the rolling window in seconds.
+        """
+        if not self.samples:
+            return 0.0
+        return sum(latency for _, latency in self.samples) / len(self.samples)
+
+    def before_request(self):
+        """
+        Check whether a request may be sent to the panel.
+
+        Raises:
+            PanelUnavailable: If the breaker is open, or half-open with a probe already in flight.
+        """
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= config.panel_cooldown:
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and self.probing):
+                raise PanelUnavailable(f'Panel {self.url} is unavailable, retrying after cooldown')
+            if self.state == self.HALF_OPEN:
+                self.probing = True
+
+    def record(self, ok: bool, latency: float):
+        """
+        Record the outcome of a request and move the breaker accordingly.
+
+        Args:
+            ok (bool): Whether the panel answered without a network or server error.
+            latency (float): Duration of the request in seconds.
+        """
+        with self._lock:
+            if ok and self.state == self.HALF_OPEN:
+                # Start the recovered panel with a clean window so old failures don't trip it again.
+                self.samples.clear()
+                self.state = self.CLOSED
+                self.probing = False
+            self.samples.append((ok, latency))
+            if ok:
+                self.consecutive_failures = 0
+                return
+
+            self.consecutive_failures += 1
+            tripped = (self.consecutive_failures >= config.panel_failure_threshold or
+                       (len(self.samples) >= config.panel_failure_threshold and
+                        self.error_rate >= config.panel_error_rate))
+            if self.state == self.HALF_OPEN or tripped:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    def abandon(self):
+        """
+        Account for a request that ended without an outcome, e.g. cancelled or failed before the
+        panel answered. An abandoned probe reopens the breaker for a fresh cooldown, so the next
+        probe isn't blocked forever.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN and self.probing:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    @property
+    def label(self) -> str:
+        """
+        Short human-readable state for admin menus.
+        """
+        if self.state == self.OPEN:
+            return '🔴'
+        if self.state == self.HALF_OPEN:
+            return '🟡'
+        if not self.samples:
+            return '⚪️'
+        return f'🟢 {int(self.latency * 1000)}ms'
+
+
+_panels: Dict[str, PanelHealth] = {}
+_panels_lock = threading.Lock()
+
+
+def get_health(url: str) -> PanelHealth:
+    """
+    Get the health of a panel, creating it on first use.
+
+    Args:
+        url (str): URL of the panel.
+
+    Returns:
+        PanelHealth: The health state shared by every session of the panel.
+    """
+    with _panels_lock:
+        health = _panels.get(url)
+        if health is None:
+            health = _panels[url] = PanelHealth(url)
+        return health
@@ -0,0 +1,101 @@
+import bisect
+import hashlib
+from typing import Iterable, List, Optional
+
+from configuration import Config
+from utilities.leader import REPLICA_ID
+
+config = Config()
+workers_db = config.get_db().workers
+
+
+def _point(key: str) -> int:
+    # md5 rather than hash() so every process places keys on the same points
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring assigning keys (e.g. server IDs) to nodes (e.g. worker IDs).
+
+    Every node is placed on the ring `vnodes` times so keys spread evenly, and when a node joins
+    or leaves only the keys next to its points move.
+
+    Args:
+        nodes (Iterable[str]): IDs of the nodes.
+        vnodes (int): Points per node on the ring.
+    """
+
+    def __init__(self, nodes: Iterable[str], vnodes: int):
+        self.nodes = sorted(set(nodes))
+        ring = sorted((_point(f'{node}#{i}'), node) for node in self.nodes for i in range(vnodes))
+        self._points = [point for point, _ in ring]
+        self._owners = [node for _, node in ring]
+
+    def owner(self, key: str) -> Optional[str]:
+        """
+        The node a key belongs to, None if the ring is empty.
+        """
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _point(key)) % len(self._points)
+        return self._owners[index]
+
+
+class Membership:
+    """
+    Registry of the live workers of a group in the `workers` collection.
+
+    Each worker heartbeats its own document; a worker that stops heartbeating drops out once its
+    entry expires, and the remaining workers pick up its keys on their next partition.
+
+    Args:
+        group (str): Name of the group of workers, e.g. usage-updater.
+        ttl (float, optional): Seconds an entry stays live after a heartbeat.
+    """
+
+    def __init__(self, group: str, ttl: float = None):
+        self.group = group
+        self.ttl = ttl or config.leader_lease_seconds
+        self.worker_id = REPLICA_ID
+        self._ring: Optional[HashRing] = None
+
+    def heartbeat(self):
+        workers_db.update_one(
+            {'_id': self.worker_id},
+            [{'$set': {
+                'group': self.group,
+                'heartbeat_at': '$$NOW',
+                'expires_at': {'$add': ['$$NOW', int(self.ttl * 1000)]}
+            }}],
+            upsert=True
+        )
+
+    def leave(self):
+        workers_db.delete_one({'_id': self.worker_id})
+
+    def live_workers(self) -> List[str]:
+        return [worker['_id'] for worker in workers_db.find(
+            {'group': self.group, '$expr': {'$gt': ['$expires_at', '$$NOW']}}, {'_id': 1})]
+
+    def ring(self) -> HashRing:
+        """
+        The hash ring of the live workers, always including this one.
+        """
+        workers = set(self.live_workers()) | {self.worker_id}
+        if self._ring is None or self._ring.nodes != sorted(workers):
+            self._ring = HashRing(workers, config.usage_worker_vnodes)
+        return self._ring
+
+    def partition(self, keys: Iterable) -> list:
+        """
+        Keep the keys owned by this worker.
+
+        Args:
+            keys (Iterable): Keys to partition, converted with str() for hashing.
+
+        Returns:
+            list: The keys owned by this worker.
+        """
+        ring = self.ring()
+        return [key for key in keys if ring.owner(str(key)) == self.worker_id]
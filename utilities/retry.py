@@ -0,0 +1,88 @@
+import logging
+import random
+import threading
+import time
+from typing import Callable, Dict
+
+import httpx
+
+from configuration import Config
+from utilities.api_call import PanelError
+
+config = Config()
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter and a per-operation retry budget.
+
+    Every operation may retry at most `budget` times per minute across all callers, so a failing
+    panel sees a bounded amount of extra load instead of a retry storm.
+
+    Args:
+        operation (str): Name of the operation, used in logs.
+        attempts (int): Maximum attempts per call, including the first one.
+        base_delay (float): Delay before the first retry in seconds.
+        max_delay (float): Upper bound of a single delay in seconds.
+        budget (int): Retries allowed per minute.
+    """
+
+    def __init__(self, operation: str, attempts: int, base_delay: float, max_delay: float, budget: int):
+        self.operation = operation
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self._tokens = float(budget)
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def delay(self, attempt: int) -> float:
+        """
+        Jittered delay before retry number `attempt` (starting at 0).
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def take_retry(self) -> bool:
+        """
+        Take one retry from the budget.
+
+        Returns:
+            bool: False if the budget for the current minute is spent.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.budget, self._tokens + (now - self._refilled_at) * self.budget / 60)
+            self._refilled_at = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def call(self, func: Callable, *args, **kwargs):
+        """
+        Call `func`, retrying transient failures (network errors and 5xx answers).
+
+        Raises:
+            The last error once attempts or the retry budget are exhausted. Permanent panel errors
+            and PanelUnavailable are raised right away.
+        """
+        for attempt in range(self.attempts):
+            try:
+                return func(*args, **kwargs)
+            except (httpx.TransportError, PanelError) as e:
+                if isinstance(e, PanelError) and not e.transient:
+                    raise
+                if attempt + 1 >= self.attempts or not self.take_retry():
+                    raise
+                delay = self.delay(attempt)
+                logging.warning(f"{self.operation} failed ({e}), retrying in {delay:.2f} seconds")
+                time.sleep(delay)
+
+
+policies: Dict[str, RetryPolicy] = {
+    operation: RetryPolicy(operation, config.panel_retry_attempts, config.panel_retry_base_delay,
+                           config.panel_retry_max_delay, config.panel_retry_budget)
+    for operation in ('add_clients', 'remove_client', 'edit_client', 'reset_client_traffic')
+}
+
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+
+class JobStats:
+    """
+    Runtime statistics of a periodic job.
+    """
+
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.overruns = 0  # Ticks skipped because the previous run was still going
+        self.followed = 0  # Ticks skipped because another replica is the leader
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+
+    @property
+    def average_duration(self) -> float:
+        return self.total_duration / self.runs if self.runs else 0.0
+
+    def record(self, duration: float, failed: bool):
+        self.runs += 1
+        self.failures += int(failed)
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.total_duration += duration
+
+    def __str__(self):
+        return (f'runs={self.runs} failures={self.failures} overruns={self.overruns} followed={self.followed} '
+                f'avg={self.average_duration:.3f}s max={self.max_duration:.3f}s last={self.last_duration:.3f}s')
+
+
+class Job:
+    """
+    A function run every `interval` seconds by the Scheduler.
+
+    Args:
+        name (str): Name of the job, used in logs and stats.
+        func (Callable): Coroutine function or blocking function to run.
+        interval (float): Seconds between the starts of two runs.
+        args (tuple): Arguments passed to `func`.
+        jitter (float): Maximum random delay added to every run, as a fraction of the interval.
+        lease: Leader lease the replica must hold to run the job, None to run on every replica.
+    """
+
+    def __init__(self, name: str, func: Callable, interval: float, args: tuple, jitter: float, lease=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.args = args
+        self.jitter = jitter
+        self.lease = lease
+        self.running: Optional[Future] = None  # Last run of a blocking function
+        self.stats = JobStats()
+
+
+class Scheduler:
+    """
+    Runs every periodic task of the process on one asyncio event loop.
+
+    Runs are scheduled on a fixed grid (start + n * interval) so they don't drift, with a small
+    random jitter so jobs don't fire in lockstep. A job never overlaps itself: ticks that pass
+    while it is still running are skipped and counted as overruns. Coroutine functions run on
+    the loop; blocking functions are offloaded to a bounded thread pool.
+
+    Long-running blocking loops that are not periodic (e.g. queue watchers) can be added as
+    services, which get a daemon thread each.
+
+    Jobs added with leader=True only run on the replica holding the job's leader lease. A
+    heartbeat acquires or renews every such lease a few times per lease lifetime, so another
+    replica takes over within seconds when the leader dies.
+
+    Args:
+        max_workers (int): Size of the thread pool for blocking jobs.
+        lease_factory (Callable, optional): Builds the leader lease of a job from its name,
+            e.g. utilities.leader.LeaderLease.
+    """
+
+    def __init__(self, max_workers: int, lease_factory: Optional[Callable] = None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scheduler')
+        self.lease_factory = lease_factory
+        self.jobs: Dict[str, Job] = {}
+        self.services: Dict[str, tuple] = {}
+        self.tasks: List[asyncio.Task] = []
+        self.heartbeat: Optional[asyncio.Task] = None
+
+    def add_job(self, name: str, func: Callable, interval: float, *args, jitter: float = 0.1, leader: bool = False):
+        """
+        Run `func(*args)` every `interval` seconds once the scheduler is started, only on the
+        leader replica if `leader` is True.
+        """
+        lease = self.lease_factory(f'job:{name}') if leader else None
+        self.jobs[name] = Job(name, func, interval, args, jitter, lease)
+
+    @property
+    def leases(self) -> list:
+        return [job.lease for job in self.jobs.values() if job.lease]
+
+    def add_service(self, name: str, func: Callable, *args):
+        """
+        Run the blocking `func(*args)` in its own daemon thread once the scheduler is started.
+        """
+        self.services[name] = (func, args)
+
+    def start(self):
+        """
+        Start every job and service. Must be called from the running event loop.
+        """
+        for name, (func, args) in self.services.items():
+            threading.Thread(target=func, args=args, name=name, daemon=True).start()
+        if self.leases:
+            self.heartbeat = asyncio.create_task(self._heartbeat(), name='leader-heartbeat')
+        for job in self.jobs.values():
+            self.tasks.append(asyncio.create_task(self._loop(job), name=job.name))
+
+    async def stop(self):
+        """
+        Cancel the periodic jobs, wait for the blocking runs in flight, then release the leader
+        leases and shut down the thread pool.
+        """
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
+
+        # A blocking run can't be cancelled; the heartbeat keeps its lease until it is done so
+        # another replica doesn't start the same job meanwhile.
+        running = [job for job in self.jobs.values() if job.running and not job.running.done()]
+        if running:
+            logging.info(f"Waiting for {', '.join(job.name for job in running)} to finish")
+            await asyncio.wait([asyncio.wrap_future(job.running) for job in running])
+        if self.heartbeat:
+            self.heartbeat.cancel()
+            await asyncio.gather(self.heartbeat, return_exceptions=True)
+            self.heartbeat = None
+        for lease in self.leases:
+            try:
+                await asyncio.to_thread(lease.release)
+            except Exception as e:
+                logging.error(f"Failed to release lease {lease.name}: {e}")
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, JobStats]:
+        return {name: job.stats for name, job in self.jobs.items()}
+
+    def log_stats(self):
+        for name, stats in self.stats().items():
+            logging.info(f"Job {name}: {stats}")
+
+    async def _heartbeat(self):
+        # Runs outside the job thread pool so busy jobs can't delay renewals past the lease's expiry
+        interval = min(lease.ttl for lease in self.leases) / 3
+        while True:
+            for lease in self.leases:
+                try:
+                    await asyncio.to_thread(lease.acquire)
+                except Exception as e:
+                    logging.error(f"Heartbeat of lease {lease.name} failed: {e}")
+            await asyncio.sleep(interval)
+
+    async def _loop(self, job: Job):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        tick = 0
+        while True:
+            delay = start + tick * job.interval + random.uniform(0, job.jitter * job.interval) - loop.time()
+            await asyncio.sleep(max(0.0, delay))
+            await self._run(job)
+
+            # Skip the ticks that passed while the job was running instead of running it back to back
+            next_tick = int((loop.time() - start) // job.interval) + 1
+            job.stats.overruns += max(0, next_tick - tick - 1)
+            tick = max(tick + 1, next_tick)
+
+    async def _run(self, job: Job):
+        if job.lease and not job.lease.is_leader:
+            job.stats.followed += 1
+            return
+
+        started = time.monotonic()
+        failed = False
+        try:
+            if asyncio.iscoroutinefunction(job.func):
+                await job.func(*job.args)
+            else:
+                job.running = self.executor.submit(job.func, *job.args)
+                await asyncio.wrap_future(job.running)
+        except Exception as e:
+            failed = True
+            logging.exception(f"Job {job.name} failed: {e}")
+
+        duration = time.monotonic() - started
+        job.stats.record(duration, failed)
+        if duration > job.interval:
+            logging.warning(f"Job {job.name} took {duration:.2f}s, longer than its {job.interval}s interval")
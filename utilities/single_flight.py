@@ -0,0 +1,84 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls so only one of them actually runs.
+
+    The first caller for a key runs the function; every caller that arrives while it is still
+    running waits for and shares its result (or exception). Once the call finishes the key is
+    forgotten, so later calls run again. Results are handed out through concurrent.futures, which
+    lets callers on different threads and event loops share one call.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key: Hashable) -> Tuple[Future, bool]:
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def _forget(self, key: Hashable, future: Future):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def do(self, key: Hashable, func: Callable, *args, **kwargs) -> Any:
+        """
+        Run `func` for `key` unless an identical call is already in flight, then share its result.
+
+        Args:
+            key (Hashable): Identity of the call, e.g. (operation, server, arguments).
+            func (Callable): The function to run.
+
+        Returns:
+            Any: The result of the single underlying call.
+        """
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._forget(key, future)
+
+    async def do_async(self, key: Hashable, func: Callable, *args, **kwargs) -> Any:
+        """
+        Asyncio counterpart of do for coroutine functions.
+
+        Args:
+            key (Hashable): Identity of the call, e.g. (operation, server, arguments).
+            func (Callable): The coroutine function to run.
+
+        Returns:
+            Any: The result of the single underlying call.
+        """
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._forget(key, future)
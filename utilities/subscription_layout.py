@@ -0,0 +1,215 @@
+"""
+subscription_layout.py
+---------
+Storage layouts of Subscription.servers, which maps a server ID to the client's (email, usage):
+
+    dict:  {'servers': {'<server id>': [email, usage], ...}}
+    array: {'servers': [{'server': ObjectId, 'email': email, 'usage': usage}, ...]}
+
+The dict layout can only be looked up by email with a dynamic `servers.<server id>` key; the
+array layout is served by the multikey (servers.server, servers.email) index. New documents are
+written in the `subscription-servers-layout` layout, migrate() converts the existing ones in the
+background, and the helpers here read and update documents in either layout meanwhile.
+"""
+import logging
+import time
+from typing import Any, Dict, List, Tuple
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from configuration import Config
+
+config = Config()
+subscriptions_db = config.get_db().subscriptions
+migrations_db = config.get_db().migrations
+
+MIGRATION_ID = 'subscription-servers-layout'
+
+LAYOUTS = ('dict', 'array')
+if config.subscription_servers_layout not in LAYOUTS:
+    raise ValueError(f"subscription-servers-layout must be one of {', '.join(LAYOUTS)}, "
+                     f"not {config.subscription_servers_layout!r}")
+
+# Documents still in the other layout
+_PENDING = {
+    'array': {'servers': {'$type': 'object'}, 'servers.0': {'$exists': False}},
+    'dict': {'servers.0': {'$exists': True}},
+}
+
+# Seconds migration_done() trusts its last read of the migration state
+_STATE_TTL = 60
+_state = {'done': False, 'checked_at': 0.0}
+
+
+def migration_done() -> bool:
+    """
+    Whether migrate_cron() found no documents left in the other layout.
+
+    The state is re-read at most every _STATE_TTL seconds, so every process notices the end of a
+    migration run by another one shortly.
+    """
+    if not _state['done'] and time.monotonic() - _state['checked_at'] >= _STATE_TTL:
+        state = migrations_db.find_one({'_id': MIGRATION_ID}) or {}
+        _state['done'] = state.get('layout') == config.subscription_servers_layout and state.get('done', False)
+        _state['checked_at'] = time.monotonic()
+    return _state['done']
+
+
+def _match(filters: Dict[str, dict]) -> dict:
+    # Once migrated to the array layout, no document is left for the dict branch, whose
+    # servers_wildcard index may be dropped (see utilities.indexes) - an unindexed $or branch
+    # would make every lookup a collection scan.
+    if config.subscription_servers_layout == 'array' and migration_done():
+        return filters['array']
+    other = 'dict' if config.subscription_servers_layout == 'array' else 'array'
+    return {'$or': [filters[config.subscription_servers_layout], filters[other]]}
+
+
+def to_document(servers: Dict[ObjectId, Tuple[str, float]], layout: str = None) -> Any:
+    """
+    Convert Subscription.servers to its stored form.
+
+    Args:
+        servers (dict): Server ID to (email, usage).
+        layout (str, optional): dict or array, the configured layout by default.
+    """
+    if (layout or config.subscription_servers_layout) == 'array':
+        return [{'server': ObjectId(key), 'email': value[0], 'usage': value[1]} for key, value in servers.items()]
+    return {str(key): list(value) for key, value in servers.items()}
+
+
+def from_document(servers: Any) -> Dict[ObjectId, Tuple[str, float]]:
+    """
+    Convert the stored form of Subscription.servers, in either layout, to server ID to (email, usage).
+    """
+    if isinstance(servers, list):
+        return {ObjectId(entry['server']): (entry['email'], entry['usage']) for entry in servers}
+    return {ObjectId(key): tuple(value) for key, value in (servers or {}).items()}
+
+
+def _filters(server_id: ObjectId, email: str) -> Dict[str, dict]:
+    return {
+        'array': {'servers': {'$elemMatch': {'server': ObjectId(server_id), 'email': email}}},
+        'dict': {f'servers.{server_id}': email},
+    }
+
+
+def client_filter(server_id: ObjectId, email: str) -> dict:
+    """
+    Query matching the subscription of a client on a server, in either layout.
+    """
+    return _match(_filters(server_id, email))
+
+
+def server_filter(server_id: ObjectId, emails: List[str]) -> dict:
+    """
+    Query matching the subscriptions of a server's clients, in either layout.
+
+    Args:
+        server_id (ObjectId): ID of the server.
+        emails (List[str]): Emails of the clients on the server.
+    """
+    return _match({
+        'array': {'servers': {'$elemMatch': {'server': ObjectId(server_id), 'email': {'$in': emails}}}},
+        'dict': {f'servers.{server_id}': {'$in': emails}},
+    })
+
+
+def _usage_update(subscription: dict, server_id: ObjectId, email: str, usage: float,
+                  inc: dict = None) -> Tuple[dict, dict]:
+    if isinstance(subscription['servers'], list):
+        query = {'_id': subscription['_id'], 'servers': {'$elemMatch': {'server': ObjectId(server_id), 'email': email}}}
+        increment = {'servers.$.usage': usage}
+    else:
+        query = {'_id': subscription['_id'], f'servers.{server_id}': email}
+        increment = {f'servers.{server_id}.1': usage}
+    return query, {'$inc': {**increment, **(inc or {})}}
+
+
+def is_migrated(subscription: dict) -> bool:
+    """
+    Whether a subscription document is stored in the configured layout, which migrate() never
+    changes again.
+    """
+    return isinstance(subscription['servers'], list) == (config.subscription_servers_layout == 'array')
+
+
+def usage_operation(subscription: dict, server_id: ObjectId, email: str, usage: float,
+                    inc: dict = None) -> UpdateOne:
+    """
+    Bulk write operation adding usage to a client's entry in a subscription, in the layout the
+    subscription is stored in.
+
+    The operation matches nothing if migrate() converts the subscription after it was read, so
+    it is only safe for migrated subscriptions (see is_migrated); use add_usage() for the others.
+
+    Args:
+        subscription (dict): The subscription document, at least its _id and servers.
+        server_id (ObjectId): ID of the server.
+        email (str): Email of the client on the server.
+        usage (float): Gigabytes to add.
+        inc (dict, optional): Other fields of the subscription to increment in the same update.
+    """
+    return UpdateOne(*_usage_update(subscription, server_id, email, usage, inc))
+
+
+def add_usage(subscription: dict, server_id: ObjectId, email: str, usage: float, inc: dict = None) -> bool:
+    """
+    Add usage to a client's entry in a subscription, reading the subscription again when
+    migrate() converted it since it was read.
+
+    Args:
+        subscription (dict): The subscription document, at least its _id and servers.
+        server_id (ObjectId): ID of the server.
+        email (str): Email of the client on the server.
+        usage (float): Gigabytes to add.
+        inc (dict, optional): Other fields of the subscription to increment in the same update.
+
+    Returns:
+        bool: Whether the usage was added, False if the client's entry is gone.
+    """
+    for _ in range(2):  # migrate() converts a document at most once
+        if subscriptions_db.update_one(*_usage_update(subscription, server_id, email, usage, inc)).matched_count:
+            return True
+        subscription = subscriptions_db.find_one({'_id': subscription['_id']}, {'servers': 1})
+        if not subscription:
+            return False
+    return False
+
+
+def migrate(batch_size: int = 500) -> int:
+    """
+    Convert a batch of subscriptions to the configured layout.
+
+    Each document is replaced only if its servers didn't change since it was read, so concurrent
+    usage updates are never lost; a document that changed is converted on a later run. The
+    migration is resumable: every run picks up the documents still in the other layout.
+
+    Args:
+        batch_size (int): Subscriptions to convert at most.
+
+    Returns:
+        int: Number of subscriptions converted.
+    """
+    layout = config.subscription_servers_layout
+    converted = 0
+    for subscription in subscriptions_db.find(_PENDING[layout], {'servers': 1}).limit(batch_size):
+        result = subscriptions_db.update_one(
+            {'_id': subscription['_id'], 'servers': subscription['servers']},
+            {'$set': {'servers': to_document(from_document(subscription['servers']), layout)}}
+        )
+        converted += result.modified_count
+    return converted
+
+
+def migrate_cron():
+    layout = config.subscription_servers_layout
+    converted = migrate()
+    if converted:
+        remaining = subscriptions_db.count_documents(_PENDING[layout])
+        logging.info(f"Converted {converted} subscriptions to the {layout} servers layout, {remaining} left")
+    else:
+        remaining = subscriptions_db.count_documents(_PENDING[layout], limit=1)
+    migrations_db.update_one({'_id': MIGRATION_ID}, {'$set': {'layout': layout, 'done': not remaining}},
+                             upsert=True)
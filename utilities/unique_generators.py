@@ -4,6 +4,7 @@ import uuid
 
 from bson import ObjectId, Binary
 from configuration import Config
+from utilities.subscription_layout import client_filter
 
 config = Config()
 subscriptions_db = config.get_db().subscriptions
@@ -37,5 +38,5 @@ def generate_unique_email(server_id: ObjectId) -> str:
 
     while True:
         local_part = ''.join(random.choice(characters) for _ in range(10))
-        if not subscriptions_db.find_one({f'servers.{server_id}': local_part}):
+        if not subscriptions_db.find_one(client_filter(server_id, local_part)):
             return local_part
@@ -9,8 +9,10 @@ from flask import Flask, request, render_template, Response
 
 from configuration import Config
 from models.subscription import Subscription
+from utilities.indexes import ensure_indexes
 
 config = Config('configuration.yaml')
+ensure_indexes()
 
 subscriptions = config.get_db().subscriptions
 
@@ -55,7 +57,9 @@ app.jinja_env.filters['datetime'] = format_datetime
 
 
 @app.route('/subscription', methods=['GET'])
-async def response():
+def response():
+    # Sync on purpose: Flask runs async views on a new event loop per request, which would defeat
+    # the per-loop panel sessions of utilities.async_api_call and leak a client per request
     accept_header = request.headers.get("Accept", "")
     user_agent = request.headers.get("User-Agent", "")
     uid = request.args.get('uuid', default='', type=str)
@@ -68,10 +72,10 @@ async def response():
     if not subscription.active:
         return "", 204
     current_time = datetime.now()
-    links = [x for x in subscription.get_links().values()]
-    links_json = json.dumps(links)
-    formatted_links = links_json.replace('"', "'")
     if "text/html" in accept_header:
+        links = [x for x in subscription.get_links().values()]
+        links_json = json.dumps(links)
+        formatted_links = links_json.replace('"', "'")
         return render_template('subscription.html', username=subscription.name,
                                now=current_time,
                                expire=subscription.expiry_time.timestamp(),